@@ -5,47 +5,61 @@ Methods to manipulate Gene Ontology annotations, create historical versions,
 expand annotations up the ontology heirarchy, etc.
 """
 
-import re
+import io
+import gzip
 import json
-from copy import deepcopy
 from collections import defaultdict
-import random
+import numpy
 
 # hooray for global vars
 verbose = False
 
 
-def _append(_dict, key, val, use='set'):
-    """Uses a defaultdict to append values to whatever
-    container is being used."""
-    assert isinstance(_dict, defaultdict)
-    if use == 'set':
-        assert isinstance(val, set)
-        _dict[key] = _dict[key].union(val)
-    elif use == 'list':
-        _dict[key].append(val)
-    elif use == 'dict':
-        assert isinstance(val, dict)
-        _dict[key].update(val)
-    else:
-        raise ValueError
+# GOA association file columns used: DB, DB object id (the UniProt id), GO id
+# and evidence code
+GOA_COLUMNS = (0, 1, 4, 6)
+
 
+def _open(filename):
+    """Opens a plain or gzipped file for reading."""
+    with open(filename, 'rb') as f:
+        gzipped = f.read(2) == '\x1f\x8b'
+    if gzipped:
+        return io.BufferedReader(gzip.open(filename, 'rb'))
+    return open(filename, 'rb')
 
-def _import_goa(goafile):
-    h = [x.strip('\n').split('\t') for x in open(goafile).readlines() if not x.startswith('!')]
-    return h
+
+def read_goa(goafile, columns=GOA_COLUMNS):
+    """Yields a tuple of the given columns of each line of a GOA association
+    file (plain or gzipped), reading it a line at a time. Comment lines are
+    skipped; missing columns are empty."""
+    last = max(columns) + 1
+    f = _open(goafile)
+    try:
+        for line in f:
+            if line.startswith('!'):
+                continue
+            # split no further than the last column needed
+            fields = line.rstrip('\n').split('\t', last)
+            if len(fields) < last:
+                fields += [''] * (last - len(fields))
+            yield tuple(fields[c] for c in columns)
+    finally:
+        f.close()
 
 
 def parse_goa(goafile, filter_nonuniprot=True, filter_iea=False):
-    goa = _import_goa(goafile)
     gdict = defaultdict(set)
-    if verbose:
-        print set([x[0] for x in goa])
-    for line in goa:
-        if (filter_nonuniprot and 'UniProt' in line[0]) or (filter_iea and line[6] != 'IEA'):
-            _append(gdict, line[1], set((line[4],)))
+    dbs = set()
+    for db, gene, goid, evidence in read_goa(goafile):
+        if verbose:
+            dbs.add(db)
+        if (filter_nonuniprot and 'UniProt' in db) or (filter_iea and evidence != 'IEA'):
+            gdict[gene].add(goid)
             if verbose:
-                print 'added ', line[1], set((line[4],))
+                print 'added ', gene, set((goid,))
+    if verbose:
+        print dbs
     return gdict
 
 
@@ -61,40 +75,69 @@ def flip_goa(goa):
 
 
 def parse_obs(obsfile):
-    """Parse the obsolete uniprot IDs as returned by UniProt's web service."""
-    h = [x.strip('\n').split('\t') for x in open(obsfile).readlines()]
+    """Parse the obsolete uniprot IDs as returned by UniProt's web service.
+    Returns {obsolete id: [replacement ids]}; deleted ids have no replacements."""
     obsdict = {}
-    for line in h:
-        name = ''
-        if line[1].startswith('Merged'):
-            name = [line[1].replace('Merged into ', '').strip('.')]
-        elif line[1].startswith('Demerged'):
-            name = [x.group() for x in re.finditer(r'[A-Z0-9]{6}', line[1])]
-        obsdict[line[0]] = name
+    with open(obsfile) as f:
+        for line in f:
+            uniprot, fate = line.strip('\n').split('\t')[:2]
+            if fate.startswith('Merged'):
+                name = [fate.replace('Merged into ', '').strip('.')]
+            elif fate.startswith('Demerged'):
+                # e.g. "Demerged into P12345, Q12345 and Q23456."
+                name = [x for x in fate[len('Demerged into '):].strip('.')
+                        .replace(',', ' ').split() if x.isalnum() and x.isupper()]
+            else:
+                name = []
+            obsdict[uniprot] = name
     return obsdict
 
 
+def resolve_obs(obs, uniprot, _seen=None):
+    """Returns the current ids that replace an obsolete id, following merges
+    and demerges into ids that are obsolete themselves (ids that only lead
+    back to obsolete ones, in a cycle, have no replacement)."""
+    seen = set() if _seen is None else _seen
+    seen.add(uniprot)
+    current = []
+    for r in obs[uniprot]:
+        if r in obs:
+            if r not in seen:
+                current.extend(x for x in resolve_obs(obs, r, seen)
+                               if x not in current)
+        elif r not in current:
+            current.append(r)
+    return current
+
+
 def replace_obs(goa, obs):
     """Finds any obsolete UniProt IDs, deletes them, and adds their annotations
-    to their replacements. For deleted ids, the annotations are also deleted."""
-    goa_cp = deepcopy(goa)
-    for uniprot in goa:
-        if uniprot in obs:
-            replacements = obs[uniprot]
-            del goa_cp[uniprot]
-            for r in replacements:
-                _append(goa_cp, r, goa[uniprot])
-            if verbose:
-                print "deleted ", uniprot
-    return goa_cp
+    to their current replacements (see resolve_obs). For deleted ids, the
+    annotations are also deleted. Works in place on goa ({gene: set of GO
+    ids}) and returns it.
+
+    For int-encoded gene arrays, see Genes.GeneUniverse.replace_obsolete."""
+    for uniprot in [g for g in goa if g in obs]:
+        terms = goa.pop(uniprot)
+        for r in resolve_obs(obs, uniprot):
+            goa.setdefault(r, set()).update(terms)
+        if verbose:
+            print "deleted ", uniprot
+    return goa
 
 
-def import_replace_flip_expand(goafile, obsfile, flatfile, keep_iea):
+def import_replace_flip_expand(goafile, obsfile, flatfile, keep_iea, obs=None,
+                               gof=None):
     """This does all the necessary transformations to a gene annotation
     file given a list of obsolete UniProt terms and a flattened file
-    that describes all isa and has_part relationships."""
-    obs = parse_obs(obsfile)
-    gof = parse_flat(flatfile)
+    that describes all isa and has_part relationships.
+
+    Already parsed obsolete ids (parse_obs) or flat ontology (parse_flat) can
+    be given instead, to be shared between calls."""
+    if obs is None:
+        obs = parse_obs(obsfile)
+    if gof is None:
+        gof = parse_flat(flatfile)
     goa = expand_goa(
             flip_goa(
                 replace_obs(
@@ -106,21 +149,28 @@ def import_replace_flip_expand(goafile, obsfile, flatfile, keep_iea):
 
 def parse_flat(goflatfile):
     """Parses the flat files generated by Ben's ontology flattener."""
-    f = [x.strip('\n\t').split('\t') for x in open(goflatfile)]
     fdict = defaultdict(set)
-    for line in f:
-        _append(fdict, line[0], set(line[1:]))
+    with open(goflatfile) as f:
+        for line in f:
+            line = line.strip('\n\t').split('\t')
+            fdict[line[0]].update(line[1:])
     return fdict
 
 
 def expand_goa(fgoa, go):
-    """Takes a flipped goa file (GO terms as keys) and expands the annotations upwards"""
-    fgoa_cp = deepcopy(fgoa)
-    for goterm in fgoa:
+    """Takes a flipped goa file (GO terms as keys) and expands the annotations upwards.
+
+    Each term in the flat ontology lists all of its ancestors, not just its
+    parents, so a single pass adding each term's own genes to each of its
+    ancestors' sets (in place) expands everything; the input isn't changed."""
+    expanded = defaultdict(set)
+    for goterm, genes in fgoa.iteritems():
+        expanded[goterm].update(genes)
+    for goterm, genes in fgoa.iteritems():
         if goterm in go:
             for parent in go[goterm]:
-                _append(fgoa_cp, parent, set(fgoa[goterm]))
-    return fgoa_cp
+                expanded[parent].update(genes)
+    return expanded
 
 
 def parse_obo(obofile):
@@ -150,36 +200,117 @@ def goa2gmt(fgoa, obo=None):
 
 
 def import_annotations(goafile, obsfile, flatfile, obofile, year=None, keep_iea=True):
-    goa = import_replace_flip_expand(goafile, obsfile, flatfile, keep_iea)
-    obo = {}
-    for term in parse_obo(obofile):
-        obo[term['id']] = term
-    annotations = {'meta': {'year': year}, 'anno': {}}
+    obs = parse_obs(obsfile)
+    obo = parse_obo_names(obofile)
     go_struct = parse_flat(flatfile)
+    goa = import_replace_flip_expand(goafile, obsfile, flatfile, keep_iea,
+                                     obs=obs, gof=go_struct)
+    annotations = {'meta': {'year': year}, 'anno': {}}
+    for entry, value in annotation_entries(goa, obo, go_struct):
+        annotations['anno'][entry] = value
+    return annotations
+
+
+def parse_obo_names(obofile):
+    """Returns {GO id: {'name': term name}} from an obo file."""
+    return dict((term['id'], {'name': term.get('name')})
+                for term in parse_obo(obofile))
+
+
+def annotation_entries(goa, obo, go_struct):
+    """Yields the (GO id, entry) pairs of the annotation files for an expanded
+    goa dict (see import_annotations), one at a time."""
     for entry in goa:
-        annotations['anno'][entry] = {
+        yield entry, {
             'name': obo[entry]['name'] if entry in obo else 'n/a',
             'genes': list(goa[entry]),
             'parents': list(go_struct[entry])
         }
-    return annotations
 
 
-def shuffle(_annotations, percentage):
-    assert percentage <= 1
-    r = random.Random()
-    r.seed()
-    annotations = deepcopy(_annotations)
+def write_annotations(out, meta, entries):
+    """Writes annotations to an open file as the same JSON object json.dump
+    would, but one term at a time, so the whole dict is never held.
+
+    Arguments:
+        meta:       the 'meta' entry
+        entries:    iterable of (GO id, entry), e.g. annotation_entries()
+    """
+    out.write('{"meta": %s, "anno": {' % json.dumps(meta))
+    for i, (term, entry) in enumerate(entries):
+        out.write('%s%s: %s' % (', ' if i else '', json.dumps(term),
+                                json.dumps(entry)))
+    out.write('}}')
+
+
+def shuffles(annotations, percentages, replicates=1, seed=None):
+    """Yields shuffled copies of an annotation dict ({'meta':..,'anno':..}),
+    as (percentage, replicate, annotations), for each replicate of each
+    percentage. In a copy, each term gives up int(l * percentage) of its l
+    genes, picked at random, to terms picked at random (possibly itself); the
+    genes of a term are left sorted and unique. The input isn't changed.
+
+    The draws for a copy are made all at once, from a numpy RandomState seeded
+    with (seed, percentage, replicate), so any copy can be made again on its
+    own; the seed is recorded in its 'meta' (picked at random if not given).
+    The genes of all the terms are held once, as flat int arrays, and each
+    copy is only built when it's yielded."""
+    if seed is None:
+        seed = int(numpy.random.randint(2**31 - 1))
     annos = annotations['anno']
-    for idx, term in enumerate(annos.keys()):
-        genes = annos[term]['genes']
-        l = len(genes)
-        rm = int(l * percentage)
-        print("(%d/%d) Moving %d/%d genes to other sets" % (idx, len(annos), rm, l))
-        random.shuffle(genes)
-        migrants = [genes.pop() for x in xrange(0, rm)]
-        annos[term]['genes'] = genes
-        for i in migrants:
-            destination = random.choice(annos.keys())
-            annos[destination]['genes'].append(i)
-    return annotations
+    terms = sorted(annos)
+    # interned annotations (see Genes.py) hold their genes as int arrays;
+    # others are interned here, to indices into names
+    interned = annotations['meta'].get('interned', False)
+    if interned:
+        names = None
+        genes = numpy.concatenate([numpy.asarray(annos[t]['genes'], dtype=numpy.int32)
+                                   for t in terms] + [numpy.empty(0, dtype=numpy.int32)])
+    else:
+        names, genes = numpy.unique(numpy.array(
+            [g for t in terms for g in annos[t]['genes']], dtype=str),
+            return_inverse=True)
+        genes = genes.astype(numpy.int32)
+    sizes = numpy.array([len(annos[t]['genes']) for t in terms], dtype=numpy.int64)
+    # the term of each gene; the genes of a term are contiguous
+    owner = numpy.repeat(numpy.arange(len(terms)), sizes)
+    rank = numpy.arange(len(genes)) - (numpy.cumsum(sizes) - sizes)[owner]
+    for percentage in percentages:
+        assert 0 <= percentage <= 1
+        moving = (sizes * percentage).astype(numpy.int64)
+        for replicate in xrange(replicates):
+            rs = numpy.random.RandomState(
+                [seed, int(round(percentage * 1e6)), replicate])
+            # each term's genes in a random order (sorting by owner keeps them
+            # in their term); the first int(l * percentage) of each move
+            order = numpy.lexsort((rs.random_sample(len(genes)), owner))
+            migrants = order[rank < moving[owner]]
+            moved = owner.copy()
+            moved[migrants] = rs.randint(0, len(terms), size=len(migrants))
+            meta = dict(annotations['meta'], shuffled=percentage, seed=seed,
+                        replicate=replicate)
+            yield percentage, replicate, {
+                'meta': meta,
+                'anno': _regroup(annos, terms, genes, moved, names)}
+
+
+def _regroup(annos, terms, genes, owner, names=None):
+    """Returns a copy of the term dict annos with the genes of each term
+    replaced by those with its index in owner (sorted and unique; as the
+    strings in names, if given)."""
+    # one sort of the (term, gene) pairs groups and dedups them all
+    n = int(genes.max()) + 1 if len(genes) else 1
+    pairs = numpy.unique(owner.astype(numpy.int64) * n + genes)
+    owner, genes = pairs // n, (pairs % n).astype(numpy.int32)
+    bounds = numpy.searchsorted(owner, numpy.arange(len(terms) + 1))
+    anno = {}
+    for i, term in enumerate(terms):
+        g = genes[bounds[i]:bounds[i+1]]
+        anno[term] = dict(annos[term],
+                          genes=g if names is None else names[g].tolist())
+    return anno
+
+
+def shuffle(_annotations, percentage, seed=None):
+    """Returns one shuffled copy of the annotations (see shuffles())."""
+    return next(shuffles(_annotations, [percentage], seed=seed))[2]
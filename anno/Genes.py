@@ -0,0 +1,259 @@
+# Author: Erik Clarke
+# The Scripps Research Institute, 2012
+"""
+A registry of every gene identifier (UniProt and Entrez) used by the pipeline,
+interned to dense int32 ids so that gene lists can be held as sorted integer
+arrays instead of lists of strings.
+
+The registry is built once and saved (see main()), then loaded by every
+worker. UniProt and Entrez ids share one id space; their formats don't collide.
+Example:
+>> universe = GeneUniverse.load('data/genes.universe.npy')
+>> universe.load_entrez_map(json.load(open('data/uniprot2entrez.json')))
+>> intern_annotations(annotations, universe)
+>> annotations['anno']['GO:0008150']['genes']
+array([    3,    17, ...], dtype=int32)
+"""
+
+import os
+import json
+import numpy
+
+ITYPE = numpy.int32
+# where the universe is saved (with its Entrez map and obsolete ids) and read
+UNIVERSE_FILE = 'data/genes.universe.npy'
+
+
+class GeneUniverse(object):
+    """Maps gene ids to dense integers and back.
+
+    Attributes:
+        ids:        list of gene ids, in order of their integer id
+        index:      {gene id: integer id}
+        to_entrez:  int32 array mapping the id of a UniProt gene to the id of
+                    its Entrez gene (-1 if unmapped); see load_entrez_map()
+        obs_ptr, obs_ids:
+                    the genes that replace each gene, as int32 arrays: gene i
+                    is replaced by obs_ids[obs_ptr[i]:obs_ptr[i+1]] (itself,
+                    unless it's obsolete); see load_obsolete_map()
+    """
+
+    def __init__(self, ids=()):
+        self.ids = []
+        self.index = {}
+        self.to_entrez = numpy.empty(0, dtype=ITYPE)
+        self.obs_ptr = numpy.zeros(1, dtype=ITYPE)
+        self.obs_ids = numpy.empty(0, dtype=ITYPE)
+        for gene in ids:
+            self.intern(gene)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, gene):
+        return gene in self.index
+
+    def intern(self, gene):
+        """Returns the integer id of the gene, adding it if it's new."""
+        try:
+            return self.index[gene]
+        except KeyError:
+            i = self.index[gene] = len(self.ids)
+            self.ids.append(gene)
+            return i
+
+    def encode(self, genes, add=True):
+        """Returns the genes as a sorted, unique int32 array of ids.
+
+        Arguments:
+            add:    intern unseen genes (if False, they are left out)
+        """
+        if add:
+            ids = [self.intern(g) for g in genes]
+        else:
+            index = self.index
+            ids = [index[g] for g in genes if g in index]
+        return numpy.unique(numpy.array(ids, dtype=ITYPE))
+
+    def decode(self, ids):
+        """Returns the gene ids for an array of integer ids."""
+        return [self.ids[i] for i in ids]
+
+    def load_entrez_map(self, uniprot2entrez_map):
+        """Interns a {UniProt: Entrez} dict as the to_entrez array."""
+        pairs = [(self.intern(u), self.intern(e))
+                 for u, e in uniprot2entrez_map.iteritems()]
+        self.to_entrez = numpy.empty(len(self), dtype=ITYPE)
+        self.to_entrez.fill(-1)
+        for u, e in pairs:
+            self.to_entrez[u] = e
+        return self
+
+    def map_entrez(self, uniprots):
+        """Returns the Entrez ids (as integer ids) of an array of UniProt ids,
+        dropping the unmapped ones (cf. enrichment_analysis.map_uniprot)."""
+        uniprots = numpy.asarray(uniprots, dtype=ITYPE)
+        # genes interned after the map was loaded have no Entrez id
+        uniprots = uniprots[uniprots < len(self.to_entrez)]
+        entrez = self.to_entrez[uniprots]
+        return entrez[entrez >= 0]
+
+    def load_obsolete_map(self, obs):
+        """Interns an {obsolete UniProt id: [replacement ids]} dict (as from
+        Annotations.parse_obs) as the obs_ptr/obs_ids lookup table. Chains of
+        obsolete ids are resolved (see Annotations.resolve_obs), so each
+        obsolete id maps straight to current ones."""
+        from Annotations import resolve_obs
+        replaced = dict((self.intern(u),
+                         [self.intern(r) for r in resolve_obs(obs, u)])
+                        for u in obs)
+        current = numpy.ones(len(self), dtype=bool)
+        current[replaced.keys()] = False
+        counts = current.astype(ITYPE)
+        for u, rs in replaced.iteritems():
+            counts[u] = len(rs)
+        self.obs_ptr = numpy.zeros(len(self) + 1, dtype=ITYPE)
+        numpy.cumsum(counts, out=self.obs_ptr[1:])
+        self.obs_ids = numpy.empty(self.obs_ptr[-1], dtype=ITYPE)
+        self.obs_ids[self.obs_ptr[:-1][current]] = numpy.flatnonzero(current)
+        for u, rs in replaced.iteritems():
+            self.obs_ids[self.obs_ptr[u]:self.obs_ptr[u+1]] = rs
+        return self
+
+    def replace_obsolete(self, ids):
+        """Returns an array of integer ids with the obsolete genes replaced
+        (cf. Annotations.replace_obs), as a sorted, unique int32 array."""
+        ids = numpy.asarray(ids, dtype=ITYPE)
+        if not self.has_obsolete_map():
+            return numpy.unique(ids)
+        # genes interned after the map was loaded aren't obsolete
+        known = ids < len(self.obs_ptr) - 1
+        kept, ids = ids[~known], ids[known]
+        starts = self.obs_ptr[ids]
+        counts = self.obs_ptr[ids + 1] - starts
+        # the positions in obs_ids of each gene's replacements, in one go
+        ends = numpy.cumsum(counts)
+        pos = numpy.arange(ends[-1] if len(ends) else 0, dtype=ITYPE)
+        pos += numpy.repeat(starts - (ends - counts), counts)
+        return numpy.union1d(self.obs_ids[pos], kept).astype(ITYPE)
+
+    def has_obsolete_map(self):
+        return len(self.obs_ids) > 0
+
+    def obsolete_map(self):
+        """Returns the lookup table as an {obsolete id: [current ids]} dict,
+        as Annotations.parse_obs would (with the chains resolved)."""
+        starts, counts = self.obs_ptr[:-1], numpy.diff(self.obs_ptr)
+        same = counts == 1
+        same[same] = (self.obs_ids[starts[same]] ==
+                      numpy.flatnonzero(same))
+        ids = self.ids
+        return dict((ids[i], [ids[r] for r in
+                              self.obs_ids[starts[i]:starts[i] + counts[i]]])
+                    for i in numpy.flatnonzero(~same).tolist())
+
+    def save(self, filename):
+        """Saves the universe as a .npy file of gene ids (plus the Entrez
+        mapping and obsolete ids, if loaded, next to it as
+        <filename>.entrez.npy and <filename>.obsolete.npz)."""
+        numpy.save(filename, numpy.array(self.ids, dtype=str))
+        if len(self.to_entrez):
+            numpy.save(_entrez_file(filename), self.to_entrez)
+        if len(self.obs_ids):
+            numpy.savez(_obsolete_file(filename), ptr=self.obs_ptr,
+                        ids=self.obs_ids)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a universe written by save()."""
+        universe = cls()
+        universe.ids = numpy.load(filename).tolist()
+        universe.index = dict((g, i) for i, g in enumerate(universe.ids))
+        try:
+            universe.to_entrez = numpy.load(_entrez_file(filename))
+        except IOError:
+            pass
+        try:
+            with numpy.load(_obsolete_file(filename)) as obs:
+                universe.obs_ptr, universe.obs_ids = obs['ptr'], obs['ids']
+        except IOError:
+            pass
+        return universe
+
+
+def _entrez_file(filename):
+    if filename.endswith('.npy'):
+        filename = filename[:-4]
+    return filename + '.entrez.npy'
+
+
+def _obsolete_file(filename):
+    if filename.endswith('.npy'):
+        filename = filename[:-4]
+    return filename + '.obsolete.npz'
+
+
+def intern_annotations(annotations, universe):
+    """Replaces each term's gene list with a sorted int32 array of ids from
+    the universe, with obsolete genes replaced if the universe has their
+    lookup table. Works in place on an annotation dict ({'meta':..,'anno':..})
+    and returns it."""
+    replace = universe.has_obsolete_map()
+    for term in annotations['anno'].itervalues():
+        term['genes'] = universe.encode(term['genes'])
+        if replace:
+            term['genes'] = universe.replace_obsolete(term['genes'])
+    annotations['meta']['interned'] = True
+    return annotations
+
+
+def interned(annotations):
+    return annotations['meta'].get('interned', False)
+
+
+def load_obsoletes(obsfile, universe_file=UNIVERSE_FILE):
+    """Returns the obsolete UniProt ids as {obsolete id: [replacement ids]}:
+    from the lookup table saved with the universe (Genes.py --obsolete) if
+    it's newer than obsfile, or else parsed from obsfile (see
+    Annotations.parse_obs)."""
+    cached = _obsolete_file(universe_file)
+    if (os.path.isfile(cached) and
+            os.path.getmtime(cached) >= os.path.getmtime(obsfile)):
+        return GeneUniverse.load(universe_file).obsolete_map()
+    from Annotations import parse_obs
+    return parse_obs(obsfile)
+
+
+def build(mapfile, annotation_files, obsfile=None):
+    """Creates a universe holding every gene in the UniProt->Entrez map and
+    the given annotation files (and the obsolete ids of obsfile, if given,
+    compiled into its lookup table)."""
+    universe = GeneUniverse()
+    universe.load_entrez_map(json.load(open(mapfile)))
+    for f in annotation_files:
+        for term in json.load(open(f))['anno'].itervalues():
+            for gene in term['genes']:
+                universe.intern(gene)
+    if obsfile:
+        from Annotations import parse_obs
+        universe.load_obsolete_map(parse_obs(obsfile))
+    # pad the Entrez map out to cover the genes added since
+    pad = numpy.empty(len(universe) - len(universe.to_entrez), dtype=ITYPE)
+    pad.fill(-1)
+    universe.to_entrez = numpy.concatenate((universe.to_entrez, pad))
+    return universe
+
+
+if __name__ == '__main__':
+    import sys
+    obsfile = None
+    if '--obsolete' in sys.argv:
+        i = sys.argv.index('--obsolete')
+        obsfile = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+    if len(sys.argv) < 4:
+        print """Usage: python Genes.py <output .npy> <uniprot2entrez.json> <anno file 1> [anno file 2...] [--obsolete obsolete.list]"""
+        sys.exit(1)
+    universe = build(sys.argv[2], sys.argv[3:], obsfile)
+    universe.save(sys.argv[1])
+    print("Saved %d genes to %s" % (len(universe), sys.argv[1]))
@@ -0,0 +1,145 @@
+# Author: Erik Clarke
+# The Scripps Research Institute, 2012
+"""
+A compiled index of a flattened ontology file (data/go-<year>.flat), so that
+sub-ontology and depth lookups are array lookups instead of a parse of the
+flat file and a dict of sets per call.
+
+The index is written once next to the flat file (<flatfile>.idx/) and
+memory-mapped from then on:
+    terms:          sorted int GO ids (see Store.goid2int) of each line's term
+    anc_offsets,
+    ancestors:      CSR-style ancestor lists (int GO ids) for each term
+    roots:          bitmask of the sub-ontology roots among a term's ancestors
+                    (see ROOTS)
+    depth:          number of ancestors of each term
+
+Example:
+>> index = load_index('data/go-2004.flat')
+>> index.in_subontology(['GO:0004281', 'GO:0019515'], 'BP')
+array([False,  True], dtype=bool)
+"""
+
+import os
+import numpy
+
+from Store import goid2int, int2goid
+
+# sub-ontology: (root GO id, name, bit)
+ROOTS = {'MF': ('GO:0003674', 'Molecular Function', 1),
+         'CC': ('GO:0005575', 'Cellular Component', 2),
+         'BP': ('GO:0008150', 'Biological Process', 4)}
+
+_arrays = ('terms', 'anc_offsets', 'ancestors', 'roots', 'depth')
+
+
+def index_name(flatfile):
+    return flatfile + '.idx'
+
+
+def compile_index(flatfile, outdir=None):
+    """Parses a flat ontology file (see Annotations.parse_flat) into an index,
+    writing it to `outdir` (default: <flatfile>.idx) if given a location."""
+    flat = {}
+    with open(flatfile) as f:
+        for line in f:
+            line = line.strip('\n\t').split('\t')
+            # some years list relation names (e.g. 'part:of') as terms;
+            # they're no GO terms, so are left out
+            if not line[0].startswith('GO:'):
+                continue
+            # repeated terms are merged, as parse_flat does
+            flat.setdefault(goid2int(line[0]), set()).update(
+                goid2int(x) for x in line[1:] if x.startswith('GO:'))
+    terms = numpy.array(sorted(flat), dtype=numpy.int32)
+    lists = [sorted(flat[t]) for t in terms.tolist()]
+    depth = numpy.array([len(x) for x in lists], dtype=numpy.int32)
+    anc_offsets = numpy.zeros(len(terms) + 1, dtype=numpy.int64)
+    anc_offsets[1:] = numpy.cumsum(depth)
+    ancestors = numpy.array([a for x in lists for a in x], dtype=numpy.int32)
+
+    roots = numpy.zeros(len(terms), dtype=numpy.uint8)
+    owner = numpy.repeat(numpy.arange(len(terms)), depth)
+    for goid, name, bit in ROOTS.itervalues():
+        roots[owner[ancestors == goid2int(goid)]] |= bit
+
+    index = OntologyIndex(terms=terms, anc_offsets=anc_offsets,
+                          ancestors=ancestors, roots=roots, depth=depth)
+    if outdir:
+        index.save(outdir)
+    return index
+
+
+def load_index(flatfile):
+    """Returns the index for a flat ontology file, memory-mapping the compiled
+    copy if there is one newer than the flat file and compiling (and saving)
+    it otherwise. Raises IOError if the flat file doesn't exist."""
+    if not os.path.isfile(flatfile):
+        raise IOError("No such flat ontology file: %s" % flatfile)
+    idx = index_name(flatfile)
+    stamp = os.path.join(idx, 'depth.npy')
+    if (os.path.isfile(stamp) and
+            os.path.getmtime(stamp) >= os.path.getmtime(flatfile)):
+        return OntologyIndex.load(idx)
+    try:
+        return compile_index(flatfile, idx)
+    except (IOError, OSError):
+        # can't write next to the flat file; use it without saving
+        return compile_index(flatfile)
+
+
+class OntologyIndex(object):
+    """Array form of a flattened ontology; see the module docstring."""
+
+    def __init__(self, **arrays):
+        for name in _arrays:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.terms)
+
+    def save(self, dirname):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # depth.npy is written last; load_index uses it to check the index
+        for name in _arrays:
+            numpy.save(os.path.join(dirname, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, dirname):
+        return cls(**dict((name, numpy.load(os.path.join(dirname, name + '.npy'),
+                                            mmap_mode='r'))
+                          for name in _arrays))
+
+    def lookup(self, goids):
+        """Returns the index of each GO id in `terms` (-1 if not present). The
+        ids may be strings or an int array of them (see goid2int)."""
+        if isinstance(goids, numpy.ndarray) and goids.dtype.kind in 'iu':
+            ids = goids.astype(numpy.int32)
+        else:
+            ids = numpy.array([goid2int(g) for g in goids], dtype=numpy.int32)
+        if not len(self.terms):
+            return numpy.zeros(len(ids), dtype=numpy.int64) - 1
+        pos = numpy.searchsorted(self.terms, ids)
+        pos[pos == len(self.terms)] = 0
+        return numpy.where(self.terms[pos] == ids, pos, -1)
+
+    def ancestors_of(self, goid):
+        i = self.lookup([goid])[0]
+        if i < 0:
+            return []
+        a, b = self.anc_offsets[i], self.anc_offsets[i + 1]
+        return [int2goid(x) for x in self.ancestors[a:b]]
+
+    def in_subontology(self, goids, ontology):
+        """Returns a boolean array, True for each term that has the root of
+        the sub-ontology (MF, CC or BP) as an ancestor. Terms missing from the
+        ontology (and the roots themselves) are False."""
+        bit = ROOTS[ontology][2]
+        pos = self.lookup(goids)
+        return (pos >= 0) & (self.roots[pos] & bit > 0)
+
+    def depths(self, goids):
+        """Returns the number of ancestors of each term (0 if missing)."""
+        pos = self.lookup(goids)
+        return numpy.where(pos >= 0, self.depth[pos], 0)
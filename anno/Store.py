@@ -0,0 +1,257 @@
+# Author: Erik Clarke
+# The Scripps Research Institute, 2012
+"""
+A compiled, memory-mapped form of the goa-<year>.json annotation files.
+
+Each annotation file is written to a directory (goa-<year>.store) of .npy
+arrays, laid out CSR-style: term i's genes are genes[gene_offsets[i]:
+gene_offsets[i+1]], and likewise for its parents and name. GO ids are stored
+as their integer part (GO:0008150 -> 8150) and genes as ids from a shared
+GeneUniverse (see Genes.py), so opening a store is a handful of mmaps and the
+pages are shared between every process reading it.
+
+Example:
+>> write_store(json.load(open('goa-2004.json')), 'goa-2004.store', universe)
+>> store = AnnotationStore('goa-2004.store')
+>> store.genes_of(store.find('GO:0008150'))
+memmap([    3,    17, ...], dtype=int32)
+>> store.entries([0, 5])                  # {GO id: {'name':.., 'genes':..}}
+>> annotations = store.to_annotations()   # same form as the json file
+
+Annotation files that haven't been compiled can be held in the same form, in
+memory (AnnotationStore.from_annotations).
+"""
+
+import os
+import json
+import numpy
+
+from Genes import ITYPE
+
+STORE_VERSION = 1
+OTYPE = numpy.int64
+
+_arrays = ('terms', 'gene_offsets', 'genes', 'parent_offsets', 'parents',
+           'name_offsets', 'names')
+
+
+def goid2int(goid):
+    """'GO:0008150' -> 8150"""
+    assert goid.startswith('GO:'), "Not a GO id: %s" % goid
+    return int(goid[3:])
+
+
+def int2goid(i):
+    """8150 -> 'GO:0008150'"""
+    return 'GO:%07d' % i
+
+
+def is_store(filename):
+    return os.path.isfile(os.path.join(filename, 'meta.json'))
+
+
+def _csr(lists, dtype):
+    """Returns (offsets, values) arrays for a list of sequences."""
+    offsets = numpy.zeros(len(lists) + 1, dtype=OTYPE)
+    offsets[1:] = numpy.cumsum([len(x) for x in lists])
+    if lists:
+        values = numpy.concatenate([numpy.asarray(x, dtype=dtype)
+                                    for x in lists])
+    else:
+        values = numpy.empty(0, dtype=dtype)
+    return offsets, values.astype(dtype)
+
+
+def gather(offsets, values, rows):
+    """Returns the values of the given rows of a CSR-style array, in one go,
+    as (index in `rows` of each value's row, values)."""
+    rows = numpy.asarray(rows, dtype=OTYPE)
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    ends = numpy.cumsum(counts)
+    which = numpy.repeat(numpy.arange(len(rows)), counts)
+    pos = numpy.arange(ends[-1] if len(ends) else 0, dtype=OTYPE)
+    pos += (starts - (ends - counts))[which]
+    return which, numpy.asarray(values)[pos]
+
+
+def write_store(annotations, dirname, universe):
+    """Writes an annotation dict ({'meta':.., 'anno':..}) to a store.
+
+    The genes are interned into `universe` (if they aren't already), so the
+    universe must be saved afterwards and every store of a set of years should
+    be written with the same one. Obsolete genes are replaced if the universe
+    has their lookup table (see Genes.GeneUniverse.load_obsolete_map).
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    arrays = store_arrays(annotations, universe)
+    for name in _arrays:
+        numpy.save(os.path.join(dirname, name + '.npy'), arrays[name])
+    with open(os.path.join(dirname, 'meta.json'), 'wb') as out:
+        json.dump({'meta': _store_meta(annotations), 'version': STORE_VERSION,
+                   'universe_size': len(universe)}, out)
+    return dirname
+
+
+def _store_meta(annotations):
+    meta = dict(annotations['meta'])
+    meta.pop('interned', None)
+    return meta
+
+
+def store_arrays(annotations, universe):
+    """Returns the arrays of a store (see write_store) of an annotation dict.
+    """
+    anno = annotations['anno']
+    interned = annotations['meta'].get('interned', False)
+    terms = sorted(anno, key=goid2int)
+    genes = [anno[t]['genes'] if interned else universe.encode(anno[t]['genes'])
+             for t in terms]
+    if universe.has_obsolete_map():
+        genes = [universe.replace_obsolete(g) for g in genes]
+    parents = [[goid2int(p) for p in anno[t].get('parents', [])]
+               for t in terms]
+    names = [numpy.frombuffer(anno[t]['name'].encode('utf-8'), dtype=numpy.uint8)
+             for t in terms]
+
+    arrays = {'terms': numpy.array([goid2int(t) for t in terms], dtype=ITYPE)}
+    arrays['gene_offsets'], arrays['genes'] = _csr(genes, ITYPE)
+    arrays['parent_offsets'], arrays['parents'] = _csr(parents, ITYPE)
+    arrays['name_offsets'], arrays['names'] = _csr(names, numpy.uint8)
+    return arrays
+
+
+def read_meta(dirname):
+    """Returns just the 'meta' entry of a store (year, shuffled, ...)."""
+    with open(os.path.join(dirname, 'meta.json')) as f:
+        return json.load(f)['meta']
+
+
+class AnnotationStore(object):
+    """A read-only, memory-mapped annotation store written by write_store()
+    (or held in memory; see from_annotations()).
+
+    Attributes:
+        meta:           the annotation metadata ({'year':.., ...})
+        universe_size:  size of the GeneUniverse the genes were interned with;
+                        the universe used with the store must be at least this
+                        large
+        terms:          int array of GO ids (see goid2int), sorted
+        genes, parents, names, with matching *_offsets: CSR-style arrays
+    """
+
+    def __init__(self, dirname):
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            info = json.load(f)
+        if info['version'] != STORE_VERSION:
+            raise ValueError("%s is a version %s annotation store; expected "
+                "version %d. Recompile it." % (dirname, info['version'],
+                                               STORE_VERSION))
+        self.dirname = dirname
+        self.meta = info['meta']
+        self.universe_size = info['universe_size']
+        for name in _arrays:
+            setattr(self, name, numpy.load(os.path.join(dirname, name + '.npy'),
+                                           mmap_mode='r'))
+
+    @classmethod
+    def from_annotations(cls, annotations, universe):
+        """Returns an annotation dict as a store held in memory, with its
+        genes interned into `universe` (as write_store would write it)."""
+        store = cls.__new__(cls)
+        store.dirname = None
+        store.meta = _store_meta(annotations)
+        store.universe_size = len(universe)
+        arrays = store_arrays(annotations, universe)
+        for name in _arrays:
+            setattr(store, name, arrays[name])
+        return store
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __repr__(self):
+        return "AnnotationStore(%s)" % (self.dirname or 'in memory')
+
+    def check_universe(self, universe):
+        """Raises ValueError unless `universe` is the one the store was
+        written with (or a superset of it)."""
+        if len(universe) < self.universe_size:
+            raise ValueError("%s was compiled with a larger gene universe "
+                "(%d genes) than the one given (%d genes)" %
+                (self.dirname, self.universe_size, len(universe)))
+
+    def lookup(self, terms):
+        """Returns the index of each of an array of int GO ids (see goid2int)
+        in the store, -1 for those not present."""
+        terms = numpy.asarray(terms, dtype=ITYPE)
+        if not len(self.terms):
+            return numpy.zeros(len(terms), dtype=OTYPE) - 1
+        pos = numpy.searchsorted(self.terms, terms)
+        pos[pos == len(self.terms)] = 0
+        return numpy.where(self.terms[pos] == terms, pos, -1)
+
+    def find(self, goid):
+        """Returns the index of a term (by GO id), or -1 if it's not present."""
+        i = numpy.searchsorted(self.terms, goid2int(goid))
+        if i < len(self.terms) and self.terms[i] == goid2int(goid):
+            return i
+        return -1
+
+    def goid(self, i):
+        return int2goid(self.terms[i])
+
+    def genes_of(self, i):
+        return self.genes[self.gene_offsets[i]:self.gene_offsets[i + 1]]
+
+    def parents_of(self, i):
+        return self.parents[self.parent_offsets[i]:self.parent_offsets[i + 1]]
+
+    def name(self, i):
+        a, b = self.name_offsets[i], self.name_offsets[i + 1]
+        return self.names[a:b].tostring().decode('utf-8')
+
+    def sizes(self):
+        """Returns the number of genes annotated to each term."""
+        return numpy.diff(self.gene_offsets)
+
+    def entries(self, rows):
+        """Returns the terms at the given indices as {GO id: {'name':..,
+        'genes':..}} (genes interned, as views onto the store), e.g. for the
+        block of terms a task tests, without building the rest."""
+        anno = {}
+        for i in numpy.asarray(rows).tolist():
+            anno[int2goid(self.terms[i])] = {'name': self.name(i),
+                'genes': numpy.asarray(self.genes_of(i))}
+        return anno
+
+    def to_annotations(self, universe=None):
+        """Returns the store as an annotation dict, in the same form as the
+        json files but with interned genes (see Genes.intern_annotations).
+        The gene arrays are views onto the mapped file, not copies.
+
+        Arguments:
+            universe:   if given, checked to be the universe the store was
+                        written with (or a superset of it)
+        """
+        if universe is not None:
+            self.check_universe(universe)
+        # split everything in bulk; per-term slicing of memmaps is slow
+        go = int2goid
+        offsets = self.gene_offsets[1:-1]
+        genes = numpy.split(numpy.asarray(self.genes), offsets)
+        blob = self.names.tostring()
+        no = self.name_offsets.tolist()
+        parents = [go(p) for p in self.parents.tolist()]
+        po = self.parent_offsets.tolist()
+        anno = {}
+        for i, term in enumerate(self.terms.tolist()):
+            anno[go(term)] = {
+                'name': blob[no[i]:no[i + 1]].decode('utf-8'),
+                'genes': genes[i],
+                'parents': parents[po[i]:po[i + 1]]
+            }
+        meta = dict(self.meta)
+        meta['interned'] = True
+        return {'meta': meta, 'anno': anno}
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compiles goa-<year>.json annotation files (as written by create_anno_year.py)
+into memory-mapped annotation stores (see Store.py), one goa-<year>.store
+directory next to each json file.
+
+All the files are compiled against one gene universe, which is created (or
+extended) and saved at --universe (default: Genes.UNIVERSE_FILE, the one the
+enrichment jobs load by default). Jobs reading the stores must load that same
+universe.
+"""
+import json
+import os
+
+import Genes
+from Store import write_store
+
+
+def store_name(annofile):
+    return os.path.splitext(annofile)[0] + '.store'
+
+
+def main(universe_file, annotation_files, mapfile):
+    if os.path.isfile(universe_file):
+        universe = Genes.GeneUniverse.load(universe_file)
+        print("Loaded %d genes from %s" % (len(universe), universe_file))
+    else:
+        universe = Genes.build(mapfile, [])
+        print("Created a new gene universe from %s" % mapfile)
+
+    for annofile in annotation_files:
+        annotations = json.load(open(annofile))
+        outdir = write_store(annotations, store_name(annofile), universe)
+        print("Compiled %d terms from %s into %s" % (len(annotations['anno']),
+            annofile, outdir))
+
+    universe.save(universe_file)
+    print("Saved %d genes to %s" % (len(universe), universe_file))
+
+
+if __name__ == '__main__':
+    import sys
+    args = sys.argv[1:]
+    mapfile = 'data/uniprot2entrez.json'
+    if '--map' in args:
+        i = args.index('--map')
+        mapfile = args[i + 1]
+        del args[i:i + 2]
+    universe_file = Genes.UNIVERSE_FILE
+    if '--universe' in args:
+        i = args.index('--universe')
+        universe_file = args[i + 1]
+        del args[i:i + 2]
+    elif args and args[0].endswith('.npy'):
+        # the universe used to be the first argument
+        universe_file = args.pop(0)
+    if not args:
+        print """Usage: python compile_anno_store.py <anno file 1> [anno file 2...] [--universe genes.universe.npy] [--map uniprot2entrez.json]"""
+        sys.exit(1)
+    main(universe_file, args, mapfile)
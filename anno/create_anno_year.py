@@ -1,42 +1,86 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import Annotations
-from Annotations import import_annotations
-import json
+from Annotations import (import_replace_flip_expand, parse_obo_names,
+    parse_flat, annotation_entries, write_annotations)
+from Genes import load_obsoletes
+import multiprocessing
 import os
 import glob
 
 Annotations.verbose = True
 
 # Downloaded from Uniprot, lists each obsolete Uniprot ID and its fate. (deleted, merged, demerged, etc)
+# Read from the lookup table compiled into the gene universe, if it's up to
+# date (see Genes.py --obsolete)
 obsoletes = 'data/obsolete.list'
 # The name of the flat ontology structure from a given year, produced by go_flattener.jar (which eats .owl files)
 flatfile = 'data/go-%d.new.flat'
 # A current GO structure (in obo format) to reference GOID->names
 go_ext_obo = 'data/gene_ontology_ext.obo'
+# The GOA association file of a species for a given year
+goa_files = 'data/goa_%s-*-%d'
 
 assert all([os.path.isfile(x) for x in (obsoletes, go_ext_obo)])
 
-def main(years, namefmt, keep_iea):
+# parsed once in main() and shared by every year's build
+_shared = {}
 
-    for year in years:
-        goafile = glob.glob('data/goa_human-*-%d' % year)
-        if goafile:
-            goafile = goafile[0]
-            print("Found goafile for %d at %s" % (year, goafile))
-        else:
-            print("Could not find human goa file for %d, skipping" % year)
-            continue
-        annotations = import_annotations(goafile, obsoletes, flatfile % year, go_ext_obo, str(year), keep_iea)
-        with open(namefmt % year, 'wb') as out:
-            json.dump(annotations, out)
+
+def build_year(args):
+    """Builds one year's annotation file; runs in a pool worker."""
+    year, namefmt, keep_iea, species = args
+    # plain or gzipped
+    goafile = sorted(glob.glob(goa_files % (species, year)) +
+        glob.glob((goa_files + '.gz') % (species, year)))
+    if goafile:
+        goafile = goafile[0]
+        print("Found goafile for %d at %s" % (year, goafile))
+    else:
+        print("Could not find %s goa file for %d, skipping" % (species, year))
+        return year, None
+    # the year's ontology is parsed once, for both the expansion and the
+    # parents of each term
+    go_struct = parse_flat(flatfile % year)
+    goa = import_replace_flip_expand(goafile, obsoletes, flatfile % year,
+        keep_iea, obs=_shared['obs'], gof=go_struct)
+    outfile = namefmt % year
+    tmp = outfile + '.tmp'
+    with open(tmp, 'wb') as out:
+        write_annotations(out, {'year': str(year)},
+            annotation_entries(goa, _shared['obo'], go_struct))
+    os.rename(tmp, outfile)
+    return year, outfile
+
+
+def main(years, namefmt, keep_iea, processes=None, species='human'):
+    _shared['obs'] = load_obsoletes(obsoletes)
+    _shared['obo'] = parse_obo_names(go_ext_obo)
+    tasks = [(year, namefmt, keep_iea, species) for year in years]
+    if processes == 1:
+        results = (build_year(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(build_year, tasks)
+    for year, outfile in results:
+        if outfile:
+            print("Wrote annotations for %d to %s" % (year, outfile))
+    if processes != 1:
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
     import sys
     if len(sys.argv) < 4:
-        print """Usage: python create_anno_year.py <beginning year> <end year> <outputname (sub %d for year)> --keep_iea"""
+        print """Usage: python create_anno_year.py <beginning year> <end year> <outputname (sub %d for year)> --keep_iea [--processes N] [--species human]"""
         sys.exit(1)
     years = xrange(int(sys.argv[1]), int(sys.argv[2])+1)
     keep_iea = '--keep_iea' in sys.argv
-    main(years, sys.argv[3], keep_iea)
+    processes = None    # one per core
+    if '--processes' in sys.argv:
+        processes = int(sys.argv[sys.argv.index('--processes') + 1])
+    species = 'human'
+    if '--species' in sys.argv:
+        species = sys.argv[sys.argv.index('--species') + 1]
+    main(years, sys.argv[3], keep_iea, processes, species)
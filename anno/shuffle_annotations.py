@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Writes shuffled copies of an annotation file (see Annotations.shuffles), for
+each replicate of each shuffle percentage, e.g. the anno/shuffled/goa-*.json
+sets used by the shuffled enrichment jobs."""
+import json
+import os
+from Annotations import shuffles, write_annotations
+
+
+def main(annofile, namefmt, percentages, replicates=1, seed=None):
+    annotations = json.load(open(annofile))
+    for pct, rep, shuffled in shuffles(annotations, percentages, replicates,
+                                       seed):
+        outfile = namefmt % {'pct': int(round(pct * 100)), 'rep': rep}
+        tmp = outfile + '.tmp'
+        with open(tmp, 'wb') as out:
+            write_annotations(out, shuffled['meta'],
+                              shuffled['anno'].iteritems())
+        os.rename(tmp, outfile)
+        print("Wrote %d%% shuffle #%d (seed %d) to %s" % (pct * 100, rep,
+            shuffled['meta']['seed'], outfile))
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 4:
+        print """Usage: python shuffle_annotations.py <annotation file> <outputname (sub %(pct)d for percentage, %(rep)d for replicate)> <percentages, e.g. 0.1,0.25,0.5> [--replicates N] [--seed S]"""
+        sys.exit(1)
+    percentages = [float(p) for p in sys.argv[3].split(',')]
+    replicates = 1
+    if '--replicates' in sys.argv:
+        replicates = int(sys.argv[sys.argv.index('--replicates') + 1])
+    seed = None
+    if '--seed' in sys.argv:
+        seed = int(sys.argv[sys.argv.index('--seed') + 1])
+    main(sys.argv[1], sys.argv[2], percentages, replicates, seed)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Columnar result files, as an alternative to the results table.
+
+Results are written to one .npz partition per dataset, year, sub-ontology (and
+shuffle level, if any):
+
+    <outdir>/<dataset>/<year>-<ontology>[-shuffled<level>].npz
+
+holding
+    goids, names:   the partition's terms (int GO ids, see Store.goid2int)
+                    and their names
+    term:           index into goids of each row
+    subsets,
+    num_genes:      the subsets, and the number of differentially expressed
+                    genes of each
+    subset:         index into subsets of each row
+    pval, qval:     float64 (qval is NaN where it hasn't been computed);
+                    version 1 partitions hold them as float32
+    meta:           json of the columns that are the same for every row of a
+                    partition (dataset, factor, year, ontology, filters, ...)
+
+See import_results.py to load the partitions into a database.
+"""
+
+import os
+import json
+import tempfile
+import numpy
+
+from Store import goid2int, int2goid
+from sink import RESULT_COLUMNS
+
+FORMAT_VERSION = 2
+# versions read_partition can read
+READABLE_VERSIONS = (1, 2)
+# columns that don't vary within a partition
+CONSTANT_COLUMNS = ('dataset', 'factor', 'year', 'ontology', 'shuffled',
+    'num_annos', 'anno_min', 'anno_max', 'min_depth', 'max_depth', 'min_var',
+    'filter_similar', 'filter_size', 'filter_depth')
+# the columns of read_partition's rows
+COLUMNS = RESULT_COLUMNS + ('qval',)
+
+
+def partition_name(outdir, dataset, year, ontology, shuffled=0.0):
+    name = '%s-%s' % (year, ontology)
+    if shuffled:
+        name += '-shuffled%s' % shuffled
+    return os.path.join(outdir, dataset, name + '.npz')
+
+
+def _codes(values):
+    """Dictionary-encodes values: returns (sorted unique values, index of
+    each value in them), the index in the smallest unsigned type."""
+    uniques, codes = numpy.unique(values, return_inverse=True)
+    return uniques, codes.astype(numpy.min_scalar_type(max(len(uniques), 1)))
+
+
+def write_partition(filename, rows, columns=RESULT_COLUMNS):
+    """Writes rows (tuples of `columns`; a 'qval' column is optional) of one
+    partition. The file is written to a temporary name and moved into place.
+    """
+    col = dict((c, i) for i, c in enumerate(columns))
+    const = dict((c, rows[0][col[c]]) for c in CONSTANT_COLUMNS)
+    for row in rows:
+        for c in CONSTANT_COLUMNS:
+            if row[col[c]] != const[c]:
+                raise ValueError("Rows of more than one partition: %s is %r "
+                    "and %r" % (c, const[c], row[col[c]]))
+    const['version'] = FORMAT_VERSION
+
+    goids, term = _codes([goid2int(row[col['goid']]) for row in rows])
+    names = {}
+    for row in rows:
+        names[goid2int(row[col['goid']])] = row[col['term']]
+    subsets, subset = _codes([row[col['subset']] for row in rows])
+    num_genes = {}
+    for row in rows:
+        num_genes[row[col['subset']]] = row[col['num_genes']]
+    if 'qval' in col:
+        qval = [numpy.nan if row[col['qval']] is None else row[col['qval']]
+                for row in rows]
+    else:
+        qval = numpy.empty(len(rows))
+        qval.fill(numpy.nan)
+
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname or '.', prefix='.tmp-',
+                               suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            numpy.savez(out,
+                goids=goids.astype(numpy.int32),
+                names=numpy.array([names[g] for g in goids.tolist()],
+                                  dtype=unicode),
+                term=term,
+                subsets=numpy.array(subsets, dtype=unicode),
+                num_genes=numpy.array([num_genes[s] for s in subsets],
+                                      dtype=numpy.int32),
+                subset=subset,
+                # float64: p-values of the strongest terms are below the
+                # float32 range
+                pval=numpy.array([row[col['pval']] for row in rows],
+                                 dtype=numpy.float64),
+                qval=numpy.asarray(qval, dtype=numpy.float64),
+                meta=numpy.array(json.dumps(const)))
+        os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return filename
+
+
+def read_partition(filename):
+    """Returns the rows of a partition as tuples of COLUMNS (qval is None
+    where it hasn't been computed)."""
+    with numpy.load(filename) as part:
+        meta = json.loads(part['meta'].item())
+        if meta.pop('version') not in READABLE_VERSIONS:
+            raise ValueError("%s is not a version %s result partition" %
+                (filename, ' or '.join(map(str, READABLE_VERSIONS))))
+        goids = [int2goid(g) for g in part['goids'].tolist()]
+        names = part['names'].tolist()
+        subsets = part['subsets'].tolist()
+        num_genes = part['num_genes'].tolist()
+        # -> float, via the shortest decimal that reads back the same (for
+        # the float32 of version 1)
+        pvals = [float(repr(p)) for p in part['pval']]
+        qvals = [None if numpy.isnan(q) else float(repr(q))
+                 for q in part['qval']]
+        term, subset = part['term'].tolist(), part['subset'].tolist()
+    rows = []
+    for k in xrange(len(term)):
+        values = dict(meta)
+        values.update(goid=goids[term[k]], term=names[term[k]],
+            subset=subsets[subset[k]], num_genes=num_genes[subset[k]],
+            pval=pvals[k], qval=qvals[k])
+        rows.append(tuple(values[c] for c in COLUMNS))
+    return rows
+
+
+def partitions(paths):
+    """Yields the partition files among the given files and directories
+    (searched recursively)."""
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for f in sorted(filenames):
+                    if f.endswith('.npz') and not f.startswith('.'):
+                        yield os.path.join(dirpath, f)
+        else:
+            yield path
+
+
+class NpzSink(object):
+    """A ResultWriter sink (see sink.py) writing partitions under `outdir`.
+    Rows are held until the writer is flushed (after each dataset) or closed;
+    a partition that is written again replaces the old file."""
+
+    def __init__(self, outdir, columns=RESULT_COLUMNS):
+        self.outdir = outdir
+        self.columns = tuple(columns)
+        self.parts = {}
+
+    def _key(self, row):
+        col = self.columns.index
+        return tuple(row[col(c)] for c in ('dataset', 'year', 'ontology',
+                                           'shuffled'))
+
+    def open(self):
+        self.parts = {}
+
+    def write(self, rows):
+        for row in rows:
+            self.parts.setdefault(self._key(row), []).append(row)
+
+    def flush(self):
+        for key in sorted(self.parts):
+            write_partition(partition_name(self.outdir, *key),
+                            self.parts[key], self.columns)
+        self.parts = {}
+
+    def close(self):
+        self.flush()
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
+import functools
 import json
 import multiprocessing
 import time
+import numpy
 
 from multiprocessing import Process
 from ConfigParser import ConfigParser
@@ -13,9 +16,15 @@ from contextlib import closing
 from statsmodels.stats import multitest
 import MySQLdb as mysql
 
-from __init__ import fetch
+from Cache import fetch_numeric, fetch_record
 import enrichment_analysis as ea
-from Annotations import parse_flat
+import schedule
+from prefetch import Prefetcher
+from sink import RESULT_COLUMNS, MySQLSink, ResultWriter, write_insert
+from columnar import NpzSink
+from Ontology import ROOTS, load_index
+from Genes import GeneUniverse, UNIVERSE_FILE
+from Store import AnnotationStore, gather, is_store, read_meta
 
 
 # MySQL commands (reference results_db_schema.sql)
@@ -23,24 +32,29 @@ set_isolation_level = """set session transaction isolation level
 read committed"""
 
 
-store_results_sql = """
-replace into {table} (ontology, goid, term, pval, dataset, factor, subset, 
-    year, num_annos, num_genes, anno_min, anno_max, min_depth, max_depth, 
-    min_var, filter_similar, filter_size, filter_depth, shuffled)
- values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+select_pvals_sql = """
+select ontology, subset, goid, pval from {table} where dataset=%s and year=%s
+ and shuffled=%s
 """
 
-select_pvals_sql = """
-select goid, pval from {table} where dataset=%s and subset=%s and year=%s 
-and ontology=%s and shuffled=%s
+# q-values are loaded into this, then set in the results with one join
+create_qvals_sql = """
+create temporary table if not exists fdr_qvals (ontology char(2),
+ subset varchar(255), goid char(10), qval double,
+ primary key (ontology, subset, goid))
 """
 
-insert_qval_sql = """
-update {table} set qval=%s where dataset=%s and subset=%s and year=%s
- and ontology=%s and shuffled=%s and goid=%s
+update_qvals_sql = """
+update {table} r join fdr_qvals t on r.ontology=t.ontology
+ and r.subset=t.subset and r.goid=t.goid set r.qval=t.qval
+ where r.dataset=%s and r.year=%s and r.shuffled=%s
 """
 
 
+# read-only inputs of the worker pool; see worker_pool()
+_shared = {}
+
+
 def split(iterable, blocks=8):
     if isinstance(iterable, dict):
         returnlist = [dict() for b in xrange(blocks)]
@@ -58,73 +72,77 @@ def split(iterable, blocks=8):
         return returnlist
 
 
-def filter_annos(annotations, _max, _min):
-    """Removes annotations that are composed of more than 'max' genes
-    or fewer than 'min'.
-    This returns a filtered copy."""
-    
-    returned = dict(annotations)
-    for k, v in annotations.iteritems():
-        if len(v['genes']) > _max or len(v['genes']) < _min:
-            del returned[k]
-    print "Removed %d terms from annotation set." % (len(annotations) - 
-        len(returned))
+def filter_annos(store, keep, _max, _min):
+    """Removes the terms (of `keep`, indices of terms in the AnnotationStore
+    `store`) that are composed of more than 'max' genes or fewer than 'min'.
+    Returns the indices kept."""
+    sizes = store.sizes()[keep]
+    returned = keep[(sizes <= _max) & (sizes >= _min)]
+    print "Removed %d terms from annotation set." % (len(keep) - len(returned))
     return returned
 
 
-def filter_annos_by_depth(annotations, min_depth, max_depth):
-    returned = dict(annotations)
-    for k, v in annotations.iteritems():
-        if len(v['parents']) < min_depth or len(v['parents']) > max_depth:
-            del returned[k]
-    print "Removed %d terms from annotation set." % (len(annotations) -
-        len(returned))
+def filter_annos_by_depth(store, keep, min_depth, max_depth, index=None):
+    """Removes terms with fewer than min_depth or more than max_depth parents.
+    If given an OntologyIndex (of the ontology the annotations were expanded
+    with), the depths are looked up there instead of counting 'parents'."""
+    if index is not None:
+        depths = index.depths(numpy.asarray(store.terms[keep]))
+    else:
+        depths = numpy.diff(store.parent_offsets)[keep]
+    returned = keep[(depths >= min_depth) & (depths <= max_depth)]
+    print "Removed %d terms from annotation set." % (len(keep) - len(returned))
     return returned
 
 
-def filter_similar_terms(annotations, min_variance):
-    returned = dict(annotations)
-    for k, v in annotations.iteritems():
-        parents = v['parents']
-        genes = v['genes']
-        for p in parents:
-            if p in annotations:
-                pgenes = annotations[p]['genes']
-                if (len(pgenes) - len(genes)) < min_variance:
-                    if k in returned:
-                        del returned[k]
-                    continue
-    print "Removed %d terms from annotation set." % (len(annotations) -
-        len(returned))
+def filter_similar_terms(store, keep, min_variance):
+    """Removes terms with fewer than min_variance genes more in one of their
+    parents (among the terms in `keep`) than in the term itself."""
+    sizes = store.sizes()
+    which, parents = gather(store.parent_offsets, store.parents, keep)
+    pos = store.lookup(parents)
+    present = numpy.zeros(len(store) + 1, dtype=bool)
+    present[keep] = True
+    # -1 (a parent not in the store) indexes the always-False last slot
+    similar = present[pos] & (sizes[pos] - sizes[keep[which]] < min_variance)
+    returned = keep[~numpy.in1d(keep, keep[which[similar]])]
+    print "Removed %d terms from annotation set." % (len(keep) - len(returned))
     return returned
 
 
-def restrict_subontology(annotation_dict, ontology, year):
-    go_id, name = {'MF': ('GO:0003674', 'Molecular Function'),
-                   'CC': ('GO:0005575', 'Cellular Component'),
-                   'BP': ('GO:0008150', 'Biological Process')}[ontology]
+def restrict_subontology(store, keep, ontology, year):
+    """Returns the terms of `keep` (indices into `store`) in a sub-ontology."""
+    go_id, name, bit = ROOTS[ontology]
     try:
-        ontology = parse_flat("data/go-%s.flat" % year)
+        index = load_index("data/go-%s.flat" % year)
     except IOError:
         print("Warning: Flattened ontology file not found for year: %s."
             " Create flattened ontology using go_flattener.jar." % year)
         print("No subontology restriction done; using all terms from all "
             "ontologies.")
-        return annotation_dict
-    returndict = dict(annotation_dict)
-    for term in annotation_dict:
-        if not go_id in ontology[term]:
-            del returndict[term]
-    print "Restricting to %s removed %d terms." % (name, 
-        (len(annotation_dict) - len(returndict)))
-    return returndict
-
-
-def get_connection(max_retries=30):
-    i = 0
-    while True and i <= max:
+        return keep
+    returned = keep[index.in_subontology(numpy.asarray(store.terms[keep]),
+                                         ontology)]
+    print "Restricting to %s removed %d terms." % (name,
+        (len(keep) - len(returned)))
+    return returned
+
+
+def depth_index(year):
+    """Returns the OntologyIndex of the flat file the year's annotations were
+    expanded with (see anno/create_anno_year.py), or None if it's missing."""
+    try:
+        return load_index(DEPTH_FLATFILE % year)
+    except IOError:
+        return None
+
+
+def get_connection(max_retries=30, **kwargs):
+    """Connects to the results database, trying up to max_retries times,
+    5 seconds apart. Extra arguments are passed on to MySQLdb.connect."""
+    for i in xrange(max_retries):
         try:
-            db = mysql.connect(MYHOST, MYUSER, MYPASS, MYDB)
+            db = mysql.connect(MYHOST, MYUSER, MYPASS, MYDB, **kwargs)
             with closing(db.cursor()) as c:
                 c.execute(set_isolation_level)
                 db.commit()
@@ -132,111 +150,191 @@ def get_connection(max_retries=30):
         except mysql.OperationalError:
             print("Operational error, sleeping for 5 seconds...")
             time.sleep(5)
-            i += 1
     print("Max retries reached, aborting...")
     raise mysql.OperationalError("Failed to connect after %d retries" 
         % max_retries)
 
 
-def store_in_db(fn):
-    def store(dataset, platform, factor, subset, annotations,
-     year, shuffled, num_annos, ontology, u2emap):
-        results, diffexp = fn(dataset, platform, factor, subset, annotations,
-         year, u2emap)
-        p = multiprocessing.current_process()
-        db = get_connection(100)
-        with closing(db.cursor()) as c:
-            col_results = []
-            for goid, pval in results.iteritems():
-                if pval == 1:
-                    continue    # we don't need to store pvals of 1
-                col_results.append((ontology, goid, annotations[goid]['name'], 
-                    pval, dataset.id, factor, subset, year, num_annos,
-                    len(diffexp), ANNO_MIN_SIZE, ANNO_MAX_SIZE, MIN_DEPTH,
-                    MAX_DEPTH, MIN_VARIANCE, FILTER_SIMILAR, FILTER_BY_SIZE,
-                    FILTER_BY_DEPTH, shuffled))
-            assert '{table}' not in store_results_sql
-            c.executemany(store_results_sql, col_results)
-            db.commit()
-        db.close()
-        print("<%s> DONE: Stored %d terms in db" % (p.name, len(results)))
-    return store
-
-
-@store_in_db
-def enriched(dataset, platform, factor, subset, annotations, 
-                year, uniprot2entrez_map):
-    diffexp = dataset.diffexpressed(subset, factor,
-        QVAL_CUTOFF)
-    diffexp = ea.map2entrez(platform, probes=diffexp)
-    background = ea.map2entrez(platform)
-    not_diffexp = [x for x in background if x not in diffexp]
+def result_rows(results, annotations, dataset_id, factor, subset, year,
+                shuffled, num_annos, ontology, num_genes):
+    """Returns the result rows (see sink.RESULT_COLUMNS) for a block of
+    results."""
+    rows = []
+    for goid, pval in results.iteritems():
+        if pval == 1:
+            continue    # we don't need to store pvals of 1
+        rows.append((ontology, goid, annotations[goid]['name'],
+            pval, dataset_id, factor, subset, year, num_annos,
+            num_genes, ANNO_MIN_SIZE, ANNO_MAX_SIZE, MIN_DEPTH,
+            MAX_DEPTH, MIN_VARIANCE, FILTER_SIMILAR, FILTER_BY_SIZE,
+            FILTER_BY_DEPTH, shuffled))
+    return rows
+
+
+def result_writer():
+    """Starts the process that stores the result rows of all the workers,
+    in the database (over one connection) or in columnar files under
+    RESULTS_DIR (see sink.py and columnar.py)."""
+    # q-values are added as each group is completed
+    columns = RESULT_COLUMNS + ('qval',)
+    if RESULTS == 'npz':
+        sink = NpzSink(RESULTS_DIR, columns)
+    else:
+        kwargs = {'local_infile': 1} if WRITE_METHOD == 'load' else {}
+        sink = MySQLSink(functools.partial(get_connection, 100, **kwargs),
+            TABLE, columns, method=WRITE_METHOD)
+    return ResultWriter(sink, complete=add_qvals, batch_rows=WRITE_BATCH)
+
+
+def enriched(annotations, diffexp, background, universe):
+    """Tests the annotations for enrichment in a subset's differentially
+    expressed genes (Entrez genes, encoded into the universe; see
+    encode_subsets)."""
     p = multiprocessing.current_process()
     total = len(annotations)
-    if len(diffexp) == 0:
-        print("Warning: no differentially expressed genes found for " +
-            "%s:%s" % (factor, subset))
-        
-    results = {}
+    results = ea._fexact_batch(diffexp, background, annotations, universe,
+        kernel=FISHER_KERNEL)
     for i, term in enumerate(annotations):
-        if len(diffexp) == 0:
-            pval = 1
-        else:
-            pval = ea._fexact(diffexp, not_diffexp, background,
-                annotations[term], uniprot2entrez_map)
+        pval = results[term]
         if pval < QVAL_CUTOFF:
             print "<{name}>: ({i}/{total}) {pval}\t{term}".format(name=p.name,
                 i=i, pval=pval, term=annotations[term]['name'], total=total)
-        results[term] = pval
-    return results, diffexp
-
-
-def multitest_correction(dataset, ontology, annotation_files):
-    annotation_years = (json.load(open(f)) for f in annotation_files)
-    factor = 'disease state'
+    return results
+
+
+def multitest_correction(dataset, ontologies, annotation_files):
+    """Recomputes the q-values of results already in the table (e.g. ones
+    stored before q-values were computed with them), in bulk: one select of
+    a year's p-values for the dataset, then the q-values go into a temporary
+    table that is joined to the results in one update."""
+    # only the metadata is needed here
+    annotation_years = (load_meta(f) for f in annotation_files)
+    if isinstance(ontologies, basestring):
+        ontologies = [ontologies]
     db = get_connection(100)
-    for annotations in annotation_years:
-        year = annotations['meta']['year']
+    with closing(db.cursor()) as c:
+        c.execute(create_qvals_sql)
+    for meta in annotation_years:
+        year = meta['year']
         # If we didn't shuffle the annotations, the shuffle level is 0
-        shuffled = annotations['meta'].get('shuffled', 0.0)
-        for subset in dataset.factors[factor]:
-            print"[%s]-[%s]-[%s]-[%s]-[%f]:" % (dataset.id, year, 
-                ontology, subset, shuffled),
-            with closing(db.cursor()) as c:
-                _id = (dataset.id, subset, year, ontology, shuffled)
-                print "selecting pvals... ",
-                c.execute(select_pvals_sql, _id)
-                # list of tuples [(_subid, pval), ...]
-                results = list(c.fetchall())
-            pvals = [x[1] for x in results] 
-            subids = [_id + (x[0],) for x in results]
-            print "calculating FDR... ",
-            rejected, qvals = multitest.fdrcorrection(pvals)
-            results = [(qvals[i],) + subids[i] for i, v in enumerate(qvals)]
-            with closing(db.cursor()) as c:
-                print "inserting %d qvals... " % len(results),
-                c.executemany(insert_qval_sql, results)
-                db.commit()
-            print "done."
+        shuffled = meta.get('shuffled', 0.0)
+        _id = (dataset.id, year, shuffled)
+        print "[%s]-[%s]-[%f]:" % (dataset.id, year, shuffled),
+        print "selecting pvals... ",
+        with closing(db.cursor()) as c:
+            c.execute(select_pvals_sql, _id)
+            results = c.fetchall()
+        groups = {}
+        for ontology, subset, goid, pval in results:
+            if ontology in ontologies:
+                groups.setdefault((ontology, subset), []).append((goid, pval))
+        print "calculating FDR for %d groups... " % len(groups),
+        qvals = []
+        for (ontology, subset), group in groups.iteritems():
+            rejected, q = multitest.fdrcorrection([x[1] for x in group])
+            qvals.extend((ontology, subset, goid, float(qval))
+                         for (goid, pval), qval in zip(group, q))
+        print "inserting %d qvals... " % len(qvals),
+        with closing(db.cursor()) as c:
+            c.execute("truncate table fdr_qvals")
+        write_insert(db, 'fdr_qvals', ('ontology', 'subset', 'goid', 'qval'),
+            qvals)
+        with closing(db.cursor()) as c:
+            c.execute(update_qvals_sql, _id)
+        db.commit()
+        print "done."
     db.close()
 
 
-def main(file_or_accn, annotation_files, ontology):
-    
+def add_qvals(rows, whole=True):
+    """Appends to each row of a group (one dataset, subset, year and
+    sub-ontology) the FDR q-value of its p-value among the group's, as
+    multitest_correction computes it. The q-values are None if the group is
+    incomplete."""
+    if not whole or not rows:
+        return [row + (None,) for row in rows]
+    pval = RESULT_COLUMNS.index('pval')
+    rejected, qvals = multitest.fdrcorrection([row[pval] for row in rows])
+    return [row + (float(q),) for row, q in zip(rows, qvals)]
+
+
+def load_universe():
+    """Loads the saved gene universe (see Genes.py), or builds one from the
+    UniProt->Entrez map if it hasn't been saved."""
+    if os.path.isfile(UNIVERSEFILE):
+        return GeneUniverse.load(UNIVERSEFILE)
     # this file can be downloaded from Uniprot's mapping service
     uniprot2entrez_map = json.load(open(MAPFILE))
     assert len(uniprot2entrez_map) > 27000
+    return GeneUniverse().load_entrez_map(uniprot2entrez_map)
+
 
-    # import the dataset
-    dataset = fetch(file_or_accn, destdir='data')
-    dataset = dataset.to_numeric()
-    dataset.filter().log2xform()
+def load_annotations(annofile, universe):
+    """Loads an annotation file as an AnnotationStore: a compiled store is
+    opened (memory-mapped) as is, a json file is parsed into one held in
+    memory, with its genes interned into the universe."""
+    if is_store(annofile):
+        store = AnnotationStore(annofile)
+        store.check_universe(universe)
+        return store
+    return AnnotationStore.from_annotations(json.load(open(annofile)),
+                                            universe)
 
-    # import the annotation files (in JSON format)
-    annotation_years = (json.load(open(f)) for f in annotation_files)
 
+def load_meta(annofile):
+    """Returns the 'meta' entry of an annotation file or store."""
+    if is_store(annofile):
+        return read_meta(annofile)
+    return json.load(open(annofile))['meta']
+
+
+def load_dataset(file_or_accn):
+    """Returns the dataset (filtered and log2 transformed, and cached for the
+    next job on it) and the platform it was run on."""
+    dataset = fetch_numeric(file_or_accn, destdir='data')
     # acquire the platform used from the dataset metadata
-    platform = fetch(dataset.meta['platform'], destdir='data')
+    platform = fetch_record(dataset.meta['platform'], destdir='data')
+    # built here, once, so every worker inherits it
+    platform.entrez_index()
+    return dataset, platform
+
+
+def load_annotation_sets(annotation_files, universe, ontologies):
+    """Loads each annotation file and applies the term filters, then
+    restricts it to each sub-ontology. Returns a list of
+    (year, shuffled, ontology, AnnotationStore, indices of the terms kept);
+    the terms are sorted by GO id, as the store is.
+
+    Every year is held for the whole run, so that the tasks of all of them
+    share one pool, but only as arrays: a compiled store is memory-mapped
+    (its pages are shared with the workers and with other jobs), and a json
+    file is parsed one at a time into an in-memory store, the parsed dict
+    being dropped before the next file is read. On goa-2004 that is 1.6 MB
+    of arrays, against 12 MB for the interned dict each year used to keep.
+    """
+    annotation_sets = []
+    for annofile in annotation_files:
+        store = load_annotations(annofile, universe)
+        year = store.meta['year']
+        shuffled = store.meta.get('shuffled', 0.0)
+        # the term filters don't depend on the sub-ontology
+        keep = filter_annotations(store, numpy.arange(len(store)), year)
+        for ontology in ontologies:
+            annotation_sets.append((year, shuffled, ontology, store,
+                restrict_subontology(store, keep, ontology, year)))
+    return annotation_sets
+
+
+def main(file_or_accn, annotation_files, ontologies):
+    """Runs the enrichment analysis of a dataset against each annotation file,
+    for each of the sub-ontologies (e.g. ['BP', 'MF', 'CC']). The dataset,
+    platform and annotations are loaded, and the differential expression
+    tests run, once for all of them."""
+
+    # gene ids are interned to ints; the universe also holds the Entrez map
+    uniprot2entrez_map = load_universe()
+
+    dataset, platform = load_dataset(file_or_accn)
 
     print("Detected %d cores, splitting into %d subprocesses..." 
         % (NCORES, NCORES))
@@ -245,47 +343,235 @@ def main(file_or_accn, annotation_files, ontology):
         jobs = []
         for annofile in annotation_files:
             p = Process(target=multitest_correction,
-                       args=(dataset, ontology, [annofile]))
+                       args=(dataset, ontologies, [annofile]))
             jobs.append(p)
             p.start()
         [p.join() for p in jobs]
         return
 
-    for annotations in annotation_years:
-        year = annotations['meta']['year']
-        annos = annotations['anno']
-        shuffled = annotations['meta'].get('shuffled', 0.0)
-        if FILTER_SIMILAR:
-            print("Filtering out terms with less than a %d-gene "
-                "difference from their parents" % MIN_VARIANCE)
-            annos = filter_similar_terms(annos, MIN_VARIANCE)
-        if FILTER_BY_DEPTH:
-            print("Filtering out terms with fewer than %d "
-                "or greater than %d parents" % (MIN_DEPTH, MAX_DEPTH))
-            annos = filter_annos_by_depth(annos, MIN_DEPTH, MAX_DEPTH)
-        if FILTER_BY_SIZE:
-            print("Filtering out annotation gene sets greater than %d "
-                "and less than %d" % (ANNO_MAX_SIZE, ANNO_MIN_SIZE))
-            annos = filter_annos(annos, ANNO_MAX_SIZE, ANNO_MIN_SIZE)
-        filtered_annotations = restrict_subontology(annos, ontology, year)
-        blocks = split(filtered_annotations, blocks=NCORES)
-        print("Split %d annotations into %d blocks of ~%d terms each..." 
-            % (len(filtered_annotations), len(blocks), len(blocks[0])))
-        # We're only looking at one factor for this analysis
-        # Iterate over factors if this is no longer true
-        factor = 'disease state'
+    # import the annotation files (in JSON format, or compiled stores)
+    annotation_sets = load_annotation_sets(annotation_files,
+        uniprot2entrez_map, ontologies)
+    writer = result_writer()
+    try:
+        pool = worker_pool(uniprot2entrez_map, annotation_sets, writer)
+        try:
+            enrich_dataset(dataset, platform, annotation_sets,
+                uniprot2entrez_map, writer, pool)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        writer.close()
+
+
+def batch_main(accessions, annotation_files, ontologies):
+    """Runs the enrichment analysis of many datasets, loading the gene
+    universe and annotations, and starting the NCORES workers, once for all
+    of them. Each dataset goes through the stages of main() in turn: parse,
+    differential expression, enrichment (on the workers) and storage (by one
+    writer for the batch).
+    The next PREFETCH datasets (and their platforms) are parsed in the
+    background meanwhile; see prefetch.py. The parent then holds the dataset
+    being enriched and at most PREFETCH more (fewer once they take
+    PREFETCH_BYTES); the workers, forked before any dataset is loaded, hold
+    none. A dataset that fails is reported and skipped."""
+    uniprot2entrez_map = load_universe()
+    annotation_sets = load_annotation_sets(annotation_files,
+        uniprot2entrez_map, ontologies)
+    print("Loaded %d annotation sets for %d datasets" % (len(annotation_sets),
+        len(accessions)))
+    failed = []
+    writer = result_writer()
+    # the workers are forked before the prefetch thread is started (by the
+    # loop below), never while it runs; see prefetch.py
+    pool = worker_pool(uniprot2entrez_map, annotation_sets, writer)
+    datasets = Prefetcher(accessions, load_dataset, depth=PREFETCH,
+        max_bytes=PREFETCH_BYTES, size=dataset_size)
+    try:
+        for n, (accn, loaded, error) in enumerate(datasets):
+            # no use going on if nothing can be stored
+            writer.check()
+            print("== [%d/%d] %s ==" % (n + 1, len(accessions), accn))
+            start = time.time()
+            try:
+                if error is not None:
+                    raise error
+                dataset, platform = loaded
+                loaded = None
+                enrich_dataset(dataset, platform, annotation_sets,
+                    uniprot2entrez_map, writer, pool)
+            except Exception as e:
+                print("Failed on %s: %s: %s" % (accn, type(e).__name__, e))
+                failed.append(accn)
+                continue
+            finally:
+                dataset = platform = None
+            print("== %s done in %.1fs ==" % (accn, time.time() - start))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        datasets.close()
+        pool.join()
+        writer.close()
+    print("Finished %d of %d datasets" % (len(accessions) - len(failed),
+        len(accessions)))
+    if failed:
+        print("Failed: %s" % ' '.join(failed))
+    return failed
+
+
+def worker_pool(universe, annotation_sets, writer):
+    """Starts the NCORES workers of a run. What they read for every dataset
+    (the universe, the annotation sets and the writer) is put in _shared
+    first, so they inherit it rather than having it pickled to them; the
+    rest comes with each task (see enrich_dataset)."""
+    _shared.update(universe=universe, annotations=annotation_sets,
+        writer=writer)
+    return multiprocessing.Pool(NCORES)
+
+
+def dataset_size(loaded):
+    """Approximate memory held by a (dataset, platform) pair, in bytes."""
+    dataset, platform = loaded
+    return dataset.matrix.nbytes + dataset.probes.nbytes
+
+
+def encode_subsets(dataset, platform, factor, universe):
+    """Returns the background genes of the platform, and the differentially
+    expressed genes of each subset of the dataset as
+    {subset: (genes, number of genes before encoding)}, as the sorted int
+    ids of their Entrez genes in the universe."""
+    # the differential expression tests don't depend on the annotations, so
+    # all the subsets are done once, up front
+    diffexpressed = dataset.diffexpressed_all(factor, QVAL_CUTOFF)
+    background = universe.encode(ea.map2entrez(platform))
+    subsets = {}
+    for subset in dataset.factors[factor]:
+        diffexp = ea.map2entrez(platform,
+            probes=dataset.probes[diffexpressed[subset], 0].tolist())
+        if len(diffexp) == 0:
+            print("Warning: no differentially expressed genes found for " +
+                "%s:%s" % (factor, subset))
+        subsets[subset] = (universe.encode(diffexp), len(diffexp))
+    return background, subsets
+
+
+def enrich_dataset(dataset, platform, annotation_sets, universe, writer,
+                   pool):
+    """Tests each annotation set for enrichment in the differentially
+    expressed genes of each subset of the dataset, on the workers of `pool`
+    (see worker_pool), which send the results to the ResultWriter `writer`.
+    Each task carries the dataset's part of its inputs: the genes of the
+    subset and background (as int arrays) and the block of terms to test."""
+    # We're only looking at one factor for this analysis
+    # Iterate over factors if this is no longer true
+    factor = 'disease state'
+    background, subsets = encode_subsets(dataset, platform, factor, universe)
+    partition = (schedule.partition if PARTITION == 'cost'
+                 else schedule.even_partition)
+    tasks = []
+    costs = {}
+    parts = []
+    for i, (year, shuffled, ontology, store, terms) in \
+            enumerate(annotation_sets):
+        # term costs depend on the platform, through the background
+        blocks = partition(schedule.term_costs(store, terms, universe,
+            background), NCORES * TASKS_PER_CORE)
+        print("Split %d %s annotations for %s into %d tasks of ~%d terms "
+            "each (cost: %.0f-%.0f)..." % (len(terms), ontology, year,
+            len(blocks), len(terms) // max(len(blocks), 1),
+            min(b[0] for b in blocks) if blocks else 0,
+            max(b[0] for b in blocks) if blocks else 0))
+        parts.append(len(blocks))
         for subset in dataset.factors[factor]:
-            print("-- [year: %s] [dataset: %s] [%s: %s] --" 
-                % (year, dataset.id, factor, subset))
-            jobs = []
-            for block in blocks:
-                p = Process(target=enriched, 
-                    args=(dataset, platform, factor, subset, block, year, 
-                        shuffled, len(filtered_annotations), ontology, 
-                        uniprot2entrez_map))
-                jobs.append(p)
-                p.start()
-            [p.join() for p in jobs]  # wait for them all to finish
+            diffexp, num_genes = subsets[subset]
+            for b, (cost, members) in enumerate(blocks):
+                costs[i, subset, b] = cost
+                tasks.append(((i, subset, b), dataset.id, factor,
+                    terms[members], diffexp, background, num_genes,
+                    len(blocks)))
+    # a group's q-values can only be computed once all its blocks are done,
+    # so the groups are run one after the other (keeping the writer from
+    # holding many at once), and within a group the most costly block first,
+    # so the cheap ones fill in the gaps at the end
+    tasks.sort(key=lambda t: (t[0][0], t[0][1], -costs[t[0]]))
+
+    print("Running %d tasks on %d worker processes..." % (len(tasks), NCORES))
+    times = schedule.WorkerTimes()
+    stored = 0
+    error = None
+    # unordered, one task at a time: idle workers take the next task
+    results = pool.imap_unordered(enrich_task, tasks)
+    while True:
+        try:
+            task, rows, worker, seconds = results.next()
+        except StopIteration:
+            break
+        except Exception as e:
+            # the pool outlives the dataset, so its other tasks are let
+            # finish before the next dataset is started
+            error = error or e
+            continue
+        i, subset, b = task
+        year, shuffled, ontology, store, terms = annotation_sets[i]
+        stored += rows
+        times.add(worker, seconds, costs[task])
+        print("-- [year: %s] [dataset: %s] [%s] [%s: %s] task %d/%d done "
+            "in %.2fs, %d terms to store --" % (year, dataset.id,
+            ontology, factor, subset, b + 1, parts[i], seconds, rows))
+    if error is not None:
+        raise error
+    # everything for this dataset has been sent; have it all stored
+    writer.flush()
+    print("Sent %d terms to be stored" % stored)
+    times.report()
+
+
+def filter_annotations(store, keep, year):
+    """Applies the configured term filters to a year's annotations (the
+    terms `keep` of `store`), returning the indices of the terms left."""
+    if FILTER_SIMILAR:
+        print("Filtering out terms with less than a %d-gene "
+            "difference from their parents" % MIN_VARIANCE)
+        keep = filter_similar_terms(store, keep, MIN_VARIANCE)
+    if FILTER_BY_DEPTH:
+        print("Filtering out terms with fewer than %d "
+            "or greater than %d parents" % (MIN_DEPTH, MAX_DEPTH))
+        keep = filter_annos_by_depth(store, keep, MIN_DEPTH, MAX_DEPTH,
+            depth_index(year))
+    if FILTER_BY_SIZE:
+        print("Filtering out annotation gene sets greater than %d "
+            "and less than %d" % (ANNO_MAX_SIZE, ANNO_MIN_SIZE))
+        keep = filter_annos(store, keep, ANNO_MAX_SIZE, ANNO_MIN_SIZE)
+    return keep
+
+
+def enrich_task(task):
+    """Runs in a pool worker: enrichment of one block of one year's
+    annotations in one sub-ontology, for one subset of a dataset (see
+    enrich_dataset for the task). The annotation sets come from _shared. The
+    result rows go to the writer. Returns the task's (set, subset, block),
+    the number of rows, the worker's name and the time taken."""
+    start = time.time()
+    (task, dataset_id, factor, block, diffexp, background, num_genes,
+        parts) = task
+    i, subset, b = task
+    year, shuffled, ontology, store, terms = _shared['annotations'][i]
+    # only the block's terms are built, from the store's arrays
+    annotations = store.entries(block)
+    results = enriched(annotations, diffexp, background, _shared['universe'])
+    rows = result_rows(results, annotations, dataset_id, factor, subset, year,
+        shuffled, len(terms), ontology, num_genes)
+    # the writer adds q-values once it has all the group's blocks
+    _shared['writer'].put(rows, group=(dataset_id, i, subset), parts=parts)
+    return (task, len(rows), multiprocessing.current_process().name,
+            time.time() - start)
 
 
 def print_usage():
@@ -302,7 +588,9 @@ configs/settings.cfg."""
 
 if __name__ == '__main__':
     parser = OptionParser(
-        usage='%prog [options] <GEO dataset> <anno file 1 [anno file 2...]>')
+        usage=('%prog [options] <GEO dataset> <anno file 1 [anno file 2...]>\n'
+            '       %prog [options] --datasets <dataset list> '
+            '<anno file 1 [anno file 2...]>'))
     config = ConfigParser()
 
     if '--config' in sys.argv:
@@ -316,9 +604,47 @@ if __name__ == '__main__':
     parser.add_option('-o', action='store', type='choice', 
         choices=['MF', 'CC', 'BP'], dest='ontology', 
         help="REQUIRED: GO sub-ontology to use (MF, CC, BP)")
+    parser.add_option('--ontologies', action='store', dest='ontologies',
+        help=("Comma-separated GO sub-ontologies to run in one job, sharing "
+            "the dataset and annotation loading (e.g. BP,MF,CC); "
+            "replaces -o"))
+    parser.add_option('--datasets', action='store', dest='datasets',
+        help=("File listing GEO datasets (accessions or files), one per "
+            "line, to run in one batch sharing the annotation loading; "
+            "all the arguments are then annotation files"))
+    parser.add_option('--prefetch', action='store', type=int,
+        dest='prefetch', default=1,
+        help=("With --datasets, number of datasets to parse ahead of the one "
+            "being enriched, so at most this many more are held in memory "
+            "(0 to parse each in turn; default: 1)"))
+    parser.add_option('--prefetch_mb', action='store', type=int,
+        dest='prefetch_mb', default=4096,
+        help=("With --datasets, stop parsing ahead while the datasets waiting "
+            "take this many MB (default: 4096)"))
+    parser.add_option('--universe', action='store', dest='universe',
+        default=UNIVERSE_FILE,
+        help=("Gene universe the annotation stores were compiled with (see "
+            "anno/compile_anno_store.py) (default: %s)" % UNIVERSE_FILE))
+    parser.add_option('--results', action='store', type='choice',
+        choices=['mysql', 'npz'], dest='results', default='mysql',
+        help=("Where results are stored: the MySQL table, or columnar .npz "
+            "files under --results_dir (see columnar.py; load them later "
+            "with import_results.py) (default: mysql)"))
+    parser.add_option('--results_dir', action='store', dest='results_dir',
+        default='data/results',
+        help="Directory for --results npz (default: data/results)")
+    parser.add_option('--write_method', action='store', type='choice',
+        choices=['insert', 'load'], dest='write_method', default='insert',
+        help=("How results are written: multi-row REPLACE statements, or LOAD "
+            "DATA LOCAL INFILE (the server must allow local_infile) "
+            "(default: insert)"))
+    parser.add_option('--write_batch', action='store', type=int,
+        dest='write_batch', default=10000,
+        help="Number of result rows written per transaction (default: 10000)")
     parser.add_option('--fdr_correction', action='store_true',
         default=False, dest='fdrcorr', 
-        help="Calculate p-values instead of doing EA")
+        help=("Recompute the q-values of results already stored, in bulk, "
+            "instead of doing EA"))
     parser.add_option('--use_shuffled', action='store_true', 
         default=False, dest='shuffled', help="Work with shuffled annotations")
     parser.add_option('--filter_by_size', action='store_true', 
@@ -350,6 +676,15 @@ if __name__ == '__main__':
             'min variance'), 
         help=("Minimum number of genes a child term must have different from a"
             " parent"))
+    parser.add_option('--logfact_pvals', action='store_true',
+        default=False, dest='logfact_pvals',
+        help=("Compute term p-values from a memoized log-factorial table "
+            "instead of scipy"))
+    parser.add_option('--partition', action='store', type='choice',
+        choices=['cost', 'even'], dest='partition', default='cost',
+        help=("How terms are split into tasks: by estimated cost (gene set "
+            "size and background overlap), or evenly by number (default: "
+            "cost)"))
     parser.add_option('--max_fdr', action='store', type=float, dest='max_fdr', 
         default=config.getfloat('FDR', 'cutoff'), 
         help="FDR q-value cutoff for defining differentially expressed genes")
@@ -360,18 +695,28 @@ if __name__ == '__main__':
 
     opts, args = parser.parse_args()
 
-    if not opts.ontology:
+    if opts.ontologies:
+        ontologies = [o.strip() for o in opts.ontologies.split(',')
+                      if o.strip()]
+    elif opts.ontology:
+        ontologies = [opts.ontology]
+    else:
+        ontologies = []
+    if not ontologies or any(o not in ROOTS for o in ontologies):
         print_usage()
         parser.print_help()
         sys.exit(1)
 
-    file_or_accn = args[0]
-    annotation_files = args[1:]
+    if opts.datasets:
+        with open(opts.datasets) as f:
+            accessions = [x.strip() for x in f if x.strip()]
+        annotation_files = args
+    else:
+        file_or_accn = args[0]
+        annotation_files = args[1:]
 
     print annotation_files
 
-    ontology = opts.ontology
-
     SHUFFLED = opts.shuffled
     FDR_CORRECTION = opts.fdrcorr
 
@@ -388,20 +733,41 @@ if __name__ == '__main__':
     MIN_VARIANCE = opts.min_variance
     
     QVAL_CUTOFF = opts.max_fdr
+    FISHER_KERNEL = ea.FisherKernel() if opts.logfact_pvals else None
     NCORES = multiprocessing.cpu_count()
+    # more tasks than workers, so the load evens out as they finish
+    TASKS_PER_CORE = 4
+    PARTITION = opts.partition
+    PREFETCH = opts.prefetch
+    PREFETCH_BYTES = opts.prefetch_mb * 2 ** 20
 
     MAPFILE = 'data/uniprot2entrez.json'
+    UNIVERSEFILE = opts.universe
+    # flattened ontology the annotation files were expanded with
+    DEPTH_FLATFILE = 'data/go-%s.new.flat'
 
     # MySQL settings
     MYUSER = config.get('MySQL', 'user')
     MYHOST = config.get('MySQL', 'host')
     MYPASS = config.get('MySQL', 'pass')
     MYDB = config.get('MySQL', 'db')
-    table = opts.sql_table
-
-    # set SQL table to insert results into
-    store_results_sql = store_results_sql.format(table=table)
-    select_pvals_sql = select_pvals_sql.format(table=table)
-    insert_qval_sql = insert_qval_sql.format(table=table)
-
-    main(file_or_accn, annotation_files, ontology)
+    TABLE = opts.sql_table
+    WRITE_METHOD = opts.write_method
+    WRITE_BATCH = opts.write_batch
+    RESULTS = opts.results
+    RESULTS_DIR = opts.results_dir
+
+    # set SQL table the results are stored in
+    select_pvals_sql = select_pvals_sql.format(table=TABLE)
+    update_qvals_sql = update_qvals_sql.format(table=TABLE)
+
+    if FDR_CORRECTION and RESULTS != 'mysql':
+        print("--fdr_correction works on the MySQL results table only")
+        sys.exit(1)
+    if opts.datasets:
+        if FDR_CORRECTION:
+            print("--fdr_correction is not supported with --datasets")
+            sys.exit(1)
+        failed = batch_main(accessions, annotation_files, ontologies)
+        sys.exit(1 if failed else 0)
+    main(file_or_accn, annotation_files, ontologies)
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from __init__ import fetch
+from Genes import GeneUniverse
 from numpy import array
 from collections import defaultdict
 import json
+import numpy
 import scipy.stats as stats
+from scipy import sparse
+from scipy.special import gammaln
 import urllib
 import urllib2
 
@@ -14,7 +17,8 @@ import os
 UNIPROT = 'http://www.uniprot.org/mapping/'
 mapfile = 'data/uniprot2entrez.json'
 
-def _fexact(diffexp, not_diffexp, background, term, uniprot2entrez_map, EASE=True):
+def _fexact(diffexp, not_diffexp, background, term, uniprot2entrez_map, EASE=True,
+            kernel=None):
     """
     Conducts a modified Fisher's exact test (aka EASE score) on the differentially 
     expressed genes and the provided gene list for the term. The test is modified
@@ -31,6 +35,7 @@ def _fexact(diffexp, not_diffexp, background, term, uniprot2entrez_map, EASE=Tru
     background: all genes (often all genes tested by the probe set)
     term: a dict of the form {'name':'term name', 'genes':['1234','1235',...]}
     EASE: if false, do a traditional Fisher's exact test, not the EASE modification
+    kernel: an optional FisherKernel to compute the p-value with (default: scipy)
     """
 
     if not diffexp:
@@ -60,12 +65,221 @@ def _fexact(diffexp, not_diffexp, background, term, uniprot2entrez_map, EASE=Tru
     not_term_genes = set([gene for gene in background if gene not in term_genes])
     ng_e = len(not_term_genes.intersection(diffexp))
     ng_ne = len(not_term_genes.intersection(not_diffexp))
+    if kernel is not None:
+        return kernel.pval(g_e, g_ne, ng_e, ng_ne)
+
     table = array([[g_e, g_ne], [ng_e, ng_ne]])
 
     odds, pval = stats.fisher_exact(table, alternative='greater')
     return pval
 
 
+def _fexact_batch(diffexp, background, annotations, uniprot2entrez_map,
+                  EASE=True, kernel=None):
+    """
+    Vectorized form of _fexact over every term in `annotations` at once.
+
+    The background is encoded once as integer gene indices and the terms are
+    laid out as a sparse (terms x genes) membership matrix, so every
+    contingency table comes out of a single matrix product and all p-values
+    out of one hypergeometric call. The genes not in `diffexp` are taken as
+    the not-differentially-expressed set, as in `enrichment.enriched`.
+
+    Returns a dict of {term: pval}, identical to calling _fexact per term.
+
+    Arguments:
+    diffexp: a list of differentially expressed genes (in Entrez Gene id format),
+        or an int array of their ids in the GeneUniverse given as
+        uniprot2entrez_map (see GeneUniverse.encode)
+    background: all genes (often all genes tested by the probe set), in the
+        same form as diffexp
+    annotations: a dict of {term: {'name':'term name', 'genes':[...]}}
+    uniprot2entrez_map: a {UniProt: Entrez} dict, or the GeneUniverse the
+        terms' genes were interned with
+    EASE: if false, do a traditional Fisher's exact test, not the EASE modification
+    kernel: an optional FisherKernel to compute the p-values with (default: scipy)
+    """
+    terms = list(annotations)
+    if len(diffexp) == 0 or not terms:
+        return dict((term, 1.0) for term in terms)
+
+    if isinstance(uniprot2entrez_map, GeneUniverse):
+        universe = uniprot2entrez_map
+    else:
+        universe = GeneUniverse()
+    if not isinstance(diffexp, numpy.ndarray):
+        diffexp = universe.encode(diffexp)
+        background = universe.encode(background)
+    genes = numpy.union1d(background, diffexp)
+    # genes encoded by another process may have been interned after this
+    # copy of the universe; none of the terms' genes can be among them
+    index = numpy.empty(max(len(universe), genes.max() + 1),
+                        dtype=numpy.int64)
+    index.fill(-1)
+    index[genes] = numpy.arange(len(genes))
+
+    # one column per gene class, so a single product gives all the counts:
+    # [diffexp, diffexp in background, background not diffexp]
+    is_e = numpy.in1d(genes, diffexp)
+    in_bg = numpy.in1d(genes, background)
+    classes = numpy.column_stack((is_e, is_e & in_bg, in_bg & ~is_e))
+    classes = classes.astype(numpy.int64)
+
+    matrix = term_matrix(terms, annotations, index, universe,
+                         uniprot2entrez_map)
+    counts = numpy.asarray(matrix.dot(classes))
+    n_bg_e = classes[:, 1].sum()
+    n_ne = classes[:, 2].sum()
+
+    g_e = counts[:, 0] - 1 if EASE else counts[:, 0]
+    g_ne = counts[:, 2]
+    ng_e = n_bg_e - counts[:, 1]
+    ng_ne = n_ne - g_ne
+
+    if kernel is not None:
+        pvals = kernel.pvals(g_e, g_ne, ng_e, ng_ne)
+    else:
+        pvals = fisher_greater(g_e, g_ne, ng_e, ng_ne)
+    pvals[g_e < 1] = 1.0
+    return dict(zip(terms, pvals.tolist()))
+
+
+def term_matrix(terms, annotations, index, universe, uniprot2entrez_map):
+    """Returns a sparse (terms x genes) 0/1 matrix of the Entrez genes
+    annotated to each term. Columns are given by `index`, an array mapping
+    each gene's id in `universe` to its column (-1 to leave the gene out).
+
+    If `uniprot2entrez_map` is the universe itself, the terms' genes are
+    taken to be interned (see Genes.intern_annotations); otherwise they are
+    UniProt ids, mapped through the dict.
+    """
+    if universe is uniprot2entrez_map:
+        term_genes = [universe.map_entrez(annotations[term]['genes'])
+                      for term in terms]
+    else:
+        term_genes = [universe.encode(map_uniprot(annotations[term]['genes'],
+                                                  uniprot2entrez_map),
+                                      add=False)
+                      for term in terms]
+    lengths = [len(g) for g in term_genes]
+    rows = numpy.repeat(numpy.arange(len(terms)), lengths)
+    cols = index[numpy.concatenate(term_genes)] if rows.size else rows
+    keep = cols >= 0
+    data = numpy.ones(keep.sum(), dtype=numpy.int64)
+    matrix = sparse.csr_matrix((data, (rows[keep], cols[keep])),
+                               shape=(len(terms), int((index >= 0).sum())))
+    # several UniProt ids can share an Entrez id; count each gene once
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def fisher_greater(g_e, g_ne, ng_e, ng_ne):
+    """One-sided (alternative='greater') Fisher's exact p-values for arrays
+    of 2x2 tables [[g_e, g_ne], [ng_e, ng_ne]].
+
+    Follows stats.fisher_exact exactly: tables with an empty row or column
+    get a p-value of 1, otherwise it is the hypergeometric tail, capped at 1.
+    Negative cells (possible in g_e after the EASE adjustment) also get 1.
+    """
+    g_e, g_ne, ng_e, ng_ne = [numpy.asarray(x, dtype=numpy.int64)
+                              for x in (g_e, g_ne, ng_e, ng_ne)]
+    n1 = g_e + g_ne
+    n2 = ng_e + ng_ne
+    valid = ((g_e >= 0) & (n1 > 0) & (n2 > 0) &
+             (g_e + ng_e > 0) & (g_ne + ng_ne > 0))
+    pvals = numpy.ones(len(g_e), dtype=numpy.float64)
+    if valid.any():
+        # stats.fisher_exact takes hypergeom.cdf(g_ne) over the second column;
+        # sum the same pmf terms here, with all tables' terms in one call
+        total = (n1 + n2)[valid]
+        good = n1[valid]
+        draws = (g_ne + ng_ne)[valid]
+        upper = g_ne[valid]
+        lower = numpy.maximum(draws - (total - good), 0)
+        lengths = upper - lower + 1
+        starts = numpy.cumsum(lengths) - lengths
+        which = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        k = numpy.arange(lengths.sum()) - starts[which] + lower[which]
+        pmf = stats.hypergeom.pmf(k, total[which], good[which], draws[which])
+        # np.sum per table (not add.reduceat) to keep the pairwise summation
+        # order of the scalar call, so the p-values agree to the last bit
+        pvals[valid] = [pmf[s:s + l].sum() for s, l in zip(starts, lengths)]
+    return numpy.minimum(pvals, 1.0)
+
+
+# tables a FisherKernel memoizes at most (a few MB)
+MAX_MEMO = 1 << 16
+
+
+class FisherKernel(object):
+    """One-sided (alternative='greater') Fisher's exact test from a table of
+    log-factorials, memoizing the p-values of the 2x2 tables it has seen.
+
+    Within a dataset/subset a table only depends on (g_e, term size, number
+    of differentially expressed genes, background size), so terms sharing
+    those (small terms especially) are looked up rather than recomputed. The
+    p-values agree with stats.fisher_exact to floating-point rounding.
+
+    A kernel lives for a whole run (every dataset of a batch), and tables
+    with other margins rarely recur, so the memo is emptied once it holds
+    max_memo tables; the log-factorial table, bounded by the background
+    size, is kept.
+
+    Attributes:
+        logfact: log(k!) for k = 0..size, grown as larger tables are seen
+        memo:    {(g_e, g_ne, ng_e, ng_ne): pval}, at most max_memo of them
+    """
+
+    def __init__(self, size=0, max_memo=MAX_MEMO):
+        self.logfact = numpy.zeros(1)
+        self.memo = {}
+        self.max_memo = max_memo
+        self._grow(size)
+
+    def _grow(self, size):
+        if size < len(self.logfact):
+            return
+        # (size * 2 so the table isn't regrown for every slightly larger one)
+        k = numpy.arange(len(self.logfact), size * 2 + 1, dtype=numpy.float64)
+        self.logfact = numpy.concatenate((self.logfact, gammaln(k + 1)))
+
+    def _logchoose(self, n, k):
+        lf = self.logfact
+        return lf[n] - lf[k] - lf[n - k]
+
+    def _compute(self, g_e, g_ne, ng_e, ng_ne):
+        n1 = g_e + g_ne
+        n2 = ng_e + ng_ne
+        draws = g_ne + ng_ne
+        if (g_e < 0 or n1 == 0 or n2 == 0 or g_e + ng_e == 0 or
+                draws == 0):
+            return 1.0
+        total = n1 + n2
+        self._grow(total)
+        # P(X <= g_ne) for X ~ hypergeom(total, n1, draws), as fisher_exact
+        k = numpy.arange(max(draws - n2, 0), g_ne + 1)
+        logpmf = (self._logchoose(n1, k) + self._logchoose(n2, draws - k) -
+                  self._logchoose(total, draws))
+        return min(numpy.exp(logpmf).sum(), 1.0)
+
+    def pval(self, g_e, g_ne, ng_e, ng_ne):
+        """Returns the p-value for the table [[g_e, g_ne], [ng_e, ng_ne]]."""
+        key = (int(g_e), int(g_ne), int(ng_e), int(ng_ne))
+        try:
+            return self.memo[key]
+        except KeyError:
+            if len(self.memo) >= self.max_memo:
+                self.memo = {}
+            pval = self.memo[key] = float(self._compute(*key))
+            return pval
+
+    def pvals(self, g_e, g_ne, ng_e, ng_ne):
+        """Returns an array of p-values for arrays of table cells."""
+        return numpy.array([self.pval(*t) for t in
+                            zip(g_e, g_ne, ng_e, ng_ne)], dtype=numpy.float64)
+
+
 def map_uniprot(uniprots, uniprot2entrez_map):
     if uniprot2entrez_map:
         return [uniprot2entrez_map[x] for x in uniprots if x in uniprot2entrez_map]
@@ -83,19 +297,16 @@ def map_uniprot(uniprots, uniprot2entrez_map):
         return response
 
 
-def map2entrez(platform, probes=None):
+def map2entrez(platform, probes=None, multi='drop'):
     """Returns the Entrez Gene ID for the probes. Some probes may not map (i.e,
-        controls, etc)- these are removed.
-    """
-    if 'ENTREZ_GENE_ID' in platform.table[0]:
-        entrez_column = platform.table[0].index('ENTREZ_GENE_ID')
-    elif 'GENE' in platform.table[0]:
-        entrez_column = platform.table[0].index('GENE')
-    else:
-        raise ValueError('Cannot find Entrez mappings for this platform!')
-    if probes == None:
-        result = [x[entrez_column] for x in platform.table]
-    else:
-        result = [x[entrez_column] for x in platform.table if x[0] in probes]
+        controls, etc)- these are removed. Probes mapping to several genes are
+        removed too, unless multi='split' (see Records.EntrezIndex.entrez).
 
-    return [x for x in result if x and '/' not in x]
+    The lookups go through the platform's EntrezIndex, which is built once.
+    """
+    index = platform.entrez_index()
+    if probes is None:
+        # the header cell (the column name) has always been part of the
+        # background; kept so results stay comparable with stored ones
+        return [index.column] + index.entrez(multi=multi)
+    return index.entrez(index.rows(probes), multi=multi)
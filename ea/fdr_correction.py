@@ -2,22 +2,25 @@
 import sys
 import enrichment as ea
 from multiprocessing import Process
-from __init__ import fetch
+from Cache import fetch_numeric
 def _usage():
     print("Corrects results from enrichment analysis for multiple comparison errors. Inserts q-values into results table.")
-    print("Usage: python fdr_correction.py <GDS file or accn> <[MF, CC, BP]> <anno file 1> [more anno files...]")
+    print("Usage: python fdr_correction.py <GDS file or accn> <[MF, CC, BP] or e.g. BP,MF,CC> <anno file 1> [more anno files...]")
     print("\n See README.md for more information.")
     sys.exit(1)
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3 or len(sys.argv[2]) != 2:
+    if len(sys.argv) < 3:
+        _usage()
+    ontologies = sys.argv[2].split(',')
+    if any(o not in ('MF', 'CC', 'BP') for o in ontologies):
         _usage()
     jobs = []
-    dataset = fetch(sys.argv[1], destdir='data')
+    dataset = fetch_numeric(sys.argv[1], destdir='data')
 
     for year in sys.argv[3:]:
         p = Process(target=ea.multitest_correction,
-                    args=(dataset, sys.argv[2], [year]))
+                    args=(dataset, ontologies, [year]))
         jobs.append(p)
         p.start()
     [p.join() for p in jobs] # wait for them all to finish
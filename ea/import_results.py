@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Loads columnar result partitions (written by enrichment.py --results npz,
+see columnar.py) into the results table of a MySQL database (settings from the
+config file, as for enrichment.py) or of an SQLite file, replacing rows that
+are already there.
+
+Usage: python import_results.py [options] <partition dir or file> [more...]
+"""
+import sys
+import time
+from ConfigParser import ConfigParser
+from optparse import OptionParser
+from contextlib import closing
+
+from columnar import COLUMNS, partitions, read_partition
+from sink import write_insert
+
+# same types as sql/results_db_schema.sql
+sqlite_schema = """
+create table if not exists {table} (
+    ontology char(2), goid char(10), term text, pval double, dataset char(7),
+    factor text, subset text, year int, num_annos int, num_genes int,
+    anno_min int, anno_max int, min_depth int, max_depth int, min_var int,
+    filter_similar boolean, filter_size boolean, filter_depth boolean,
+    shuffled float, qval double,
+    primary key (dataset, subset, year, ontology, goid)
+)
+"""
+
+
+def sqlite_writer(filename, table):
+    import sqlite3
+    db = sqlite3.connect(filename)
+    db.execute(sqlite_schema.format(table=table))
+    sql = "insert or replace into %s (%s) values (%s)" % (table,
+        ', '.join(COLUMNS), ','.join(['?'] * len(COLUMNS)))
+
+    def write(rows):
+        db.executemany(sql, rows)
+        db.commit()
+    return db, write
+
+
+def mysql_writer(config, table):
+    import MySQLdb as mysql
+    db = mysql.connect(config.get('MySQL', 'host'),
+        config.get('MySQL', 'user'), config.get('MySQL', 'pass'),
+        config.get('MySQL', 'db'), charset='utf8', use_unicode=True)
+
+    def write(rows):
+        write_insert(db, table, COLUMNS, rows)
+    return db, write
+
+
+def main(paths, db, write):
+    start = time.time()
+    files = rows = 0
+    for filename in partitions(paths):
+        part = read_partition(filename)
+        write(part)
+        files += 1
+        rows += len(part)
+        print("%s: %d rows" % (filename, len(part)))
+    db.close()
+    print("Imported %d rows from %d partitions in %.1fs" % (rows, files,
+        time.time() - start))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(
+        usage='%prog [options] <partition dir or file> [more...]')
+    parser.add_option('--sqlite', action='store', dest='sqlite',
+        help="SQLite database file to import into (instead of MySQL)")
+    parser.add_option('--config', action='store', dest='config',
+        default='configs/settings.cfg',
+        help="Config file with the MySQL settings")
+    parser.add_option('--sql_table', action='store', dest='sql_table',
+        help="Table to import into (default: the config's, or 'results')")
+    opts, args = parser.parse_args()
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+
+    config = ConfigParser()
+    config.read(opts.config)
+    table = opts.sql_table
+    if not table:
+        table = (config.get('MySQL', 'table') if config.has_section('MySQL')
+                 else 'results')
+    if opts.sqlite:
+        db, write = sqlite_writer(opts.sqlite, table)
+    else:
+        db, write = mysql_writer(config, table)
+    main(args, db, write)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Loads items (e.g. datasets) in a background thread, ahead of the one being
+worked on, so that parsing the next dataset overlaps with enrichment of the
+current one.
+
+At most `depth` loaded items wait to be taken: the loader only starts on an
+item once there's room for it, and not while the waiting items add up to
+`max_bytes` or more (so it can go over by at most one item). With the item
+being worked on, at most depth + 1 loaded items are held at once.
+
+The thread is started by the first iteration. Fork any processes (e.g. a
+multiprocessing.Pool) before that: a process forked while the thread runs
+gets a copy of any lock the thread holds at that moment (the import lock,
+the queue's, stdio's) already taken, and can deadlock on it.
+
+Example:
+>> for accn, (dataset, platform), error in Prefetcher(accessions, load_dataset,
+..                                                     depth=1):
+..     if error is None:
+..         enrich(dataset, platform)
+"""
+
+import sys
+import threading
+import Queue
+
+_done = object()
+
+
+class Prefetcher(object):
+    """Iterates over (item, loaded value, exception) in the order of `items`,
+    calling `load(item)` in a background thread. If loading an item raised an
+    exception, the value is None and the exception is given instead.
+
+    Arguments:
+        depth:      number of loaded items that can be waiting; 0 loads each
+                    item when it's asked for, in the calling thread
+        max_bytes:  cap on the size of the waiting items (None for no cap)
+        size:       function returning the size of a loaded value in bytes
+    """
+
+    def __init__(self, items, load, depth=1, max_bytes=None, size=None):
+        self.items = list(items)
+        self.load = load
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.size = size or (lambda value: 0)
+        self.waiting_bytes = 0
+        self._queue = Queue.Queue(maxsize=max(depth, 1))
+        self._room = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def _load(self, item):
+        try:
+            return item, self.load(item), None
+        except Exception:
+            return item, None, sys.exc_info()[1]
+
+    def _over_cap(self):
+        return (self.max_bytes is not None and not self._queue.empty() and
+                self.waiting_bytes >= self.max_bytes)
+
+    def _full(self):
+        # the loader is the only producer, so qsize() can only go down
+        # under it
+        return self._queue.qsize() >= self.depth or self._over_cap()
+
+    def _run(self):
+        for item in self.items:
+            with self._room:
+                while self._full() and not self._stopped:
+                    self._room.wait(1)
+            if self._stopped:
+                return
+            result = self._load(item)
+            nbytes = self.size(result[1]) if result[1] is not None else 0
+            with self._room:
+                self.waiting_bytes += nbytes
+            self._queue.put(result + (nbytes,))
+        self._queue.put(_done)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for item in self.items:
+                yield self._load(item)
+            return
+        self._thread = threading.Thread(target=self._run, name='prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+        try:
+            while True:
+                result = self._queue.get()
+                if result is _done:
+                    return
+                item, value, error, nbytes = result
+                with self._room:
+                    self.waiting_bytes -= nbytes
+                    self._room.notify()
+                # drop our reference before handing it over, so it can go
+                # as soon as the caller is done with it
+                result = None
+                yield item, value, error
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops loading; items already loaded are dropped."""
+        self._stopped = True
+        with self._room:
+            self._room.notify()
+        # unblock the loader if it's waiting to put an item
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Partitions GO terms into enrichment tasks of near-equal cost, and reports
+how long each worker spent on them.
+
+The cost of testing a term is dominated by its gene set: its row in the
+term x gene matrix, and its overlap with the background, which bounds the
+length of the hypergeometric sum for its p-value. A few terms near the roots
+have thousands of genes, so dealing out equal numbers of terms leaves some
+workers with far more work than others.
+
+Example:
+>> costs = term_costs(store, terms, universe, background)
+>> for cost, members in partition(costs, 32):
+..     block = terms[members]
+"""
+
+import heapq
+import time
+import numpy
+from Store import gather
+
+# fixed cost of a term (dict lookups, bookkeeping), in genes
+TERM_COST = 20.0
+
+
+def term_costs(store, terms, universe, background):
+    """Returns the estimated cost of testing each of `terms`: TERM_COST, plus
+    its number of genes, plus the number of them in the background.
+
+    Arguments:
+        store:      AnnotationStore, genes interned into `universe`
+        terms:      indices of the terms in `store`
+        universe:   GeneUniverse holding the Entrez map
+        background: int ids of the background's Entrez genes
+    """
+    sizes = store.sizes()[terms]
+    costs = TERM_COST + sizes.astype(float)
+    if not sizes.sum():
+        return costs
+    owner, genes = gather(store.gene_offsets, store.genes, terms)
+    # genes interned after the Entrez map was loaded have no Entrez id
+    known = genes < len(universe.to_entrez)
+    entrez = universe.to_entrez[genes[known]]
+    in_bg = numpy.in1d(entrez, background) & (entrez >= 0)
+    costs += numpy.bincount(owner[known], weights=in_bg, minlength=len(terms))
+    return costs
+
+
+def partition(costs, chunks):
+    """Packs items into (at most) `chunks` groups of near-equal total cost,
+    placing each one, most costly first, into the least loaded group.
+    Returns a list of (total cost, [item indices]), most costly first."""
+    chunks = max(min(chunks, len(costs)), 1)
+    groups = [(0.0, g, []) for g in xrange(chunks)]
+    for k in numpy.argsort(-numpy.asarray(costs), kind='mergesort').tolist():
+        total, g, members = heapq.heappop(groups)
+        members.append(k)
+        heapq.heappush(groups, (total + costs[k], g, members))
+    groups.sort(reverse=True)
+    return [(total, members) for total, g, members in groups if members]
+
+
+def even_partition(costs, chunks):
+    """Splits items into (at most) `chunks` contiguous groups of near-equal
+    size, regardless of cost. Same return value as partition()."""
+    n = len(costs)
+    chunks = max(min(chunks, n), 1)
+    bounds = [n * k // chunks for k in xrange(chunks + 1)]
+    return [(float(numpy.sum(costs[a:b])), range(a, b))
+            for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+
+class WorkerTimes(object):
+    """Collects (worker, seconds, cost) for each finished task and reports
+    the busy time of each worker and when it finished its last task."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.workers = {}
+
+    def add(self, worker, seconds, cost):
+        tasks, busy, total, done = self.workers.get(worker, (0, 0.0, 0.0, 0))
+        self.workers[worker] = (tasks + 1, busy + seconds, total + cost,
+                                time.time() - self.start)
+
+    def report(self):
+        if not self.workers:
+            return
+        print("%-20s %6s %10s %12s %10s" % ('worker', 'tasks', 'busy (s)',
+            'cost', 'done (s)'))
+        for worker in sorted(self.workers):
+            print("%-20s %6d %10.2f %12.0f %10.2f" %
+                ((worker,) + self.workers[worker]))
+        busy = [x[1] for x in self.workers.values()]
+        done = [x[3] for x in self.workers.values()]
+        print("Wall time %.2fs; busy %.2fs per worker (max %.2fs); "
+            "tail (last worker done - first worker done) %.2fs" %
+            (max(done), sum(busy) / len(busy), max(busy),
+             max(done) - min(done)))
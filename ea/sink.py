@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""A single writer process for result rows.
+
+Workers put their rows on the writer's queue instead of each opening a
+connection to the database. The writer holds one sink for its lifetime:
+MySQLSink, or NpzSink (columnar files; see columnar.py). It collects rows into
+batches of up to `batch_rows` and hands each batch to the sink. A batch is
+also written when no rows have arrived for `flush_secs`.
+
+Rows can be put in groups that arrive in parts (e.g. the term blocks of one
+dataset, subset, year and sub-ontology). A group is held until all its parts
+are in, then passed through the writer's `complete` function as a whole,
+which is where q-values are added (see enrichment.add_qvals).
+
+MySQLSink writes each batch in one transaction, either as multi-row REPLACE
+statements ('insert') or through a temporary file and LOAD DATA LOCAL INFILE
+('load'; the server must allow local_infile).
+
+The queue is bounded, so workers wait if the sink falls behind.
+
+Example:
+>> writer = ResultWriter(MySQLSink(connect, 'results', RESULT_COLUMNS))
+>> writer.put([(...), (...)])    # from any process forked after this
+>> writer.put(rows, group=key, parts=8)
+>> writer.flush()                # e.g. after each dataset
+>> writer.check()                # raises if the writer has failed
+>> writer.close()                # flushes, waits, raises if the writer failed
+"""
+
+import os
+import time
+import tempfile
+import multiprocessing
+import Queue
+from contextlib import closing
+
+# columns of each result row (see enrichment.result_rows)
+RESULT_COLUMNS = ('ontology', 'goid', 'term', 'pval', 'dataset', 'factor',
+    'subset', 'year', 'num_annos', 'num_genes', 'anno_min', 'anno_max',
+    'min_depth', 'max_depth', 'min_var', 'filter_similar', 'filter_size',
+    'filter_depth', 'shuffled')
+
+METHODS = ('insert', 'load')
+# rows per REPLACE statement, well under the default max_allowed_packet
+STATEMENT_ROWS = 1000
+
+
+# queued by ResultWriter.flush()
+_FLUSH = 'flush'
+
+
+class WriterError(Exception):
+    pass
+
+
+def replace_sql(table, columns, nrows):
+    """Returns a REPLACE statement for nrows rows of the columns."""
+    row = '(%s)' % ','.join(['%s'] * len(columns))
+    return "replace into %s (%s) values %s" % (table, ', '.join(columns),
+        ','.join([row] * nrows))
+
+
+def load_sql(table, columns):
+    return ("load data local infile %%s replace into table %s character set "
+        "utf8 fields terminated by '\\t' escaped by '\\\\' lines terminated by "
+        "'\\n' (%s)" % (table, ', '.join(columns)))
+
+
+def _field(value):
+    """Formats a value as a LOAD DATA field."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n'))
+
+
+def write_insert(db, table, columns, rows):
+    with closing(db.cursor()) as c:
+        for i in xrange(0, len(rows), STATEMENT_ROWS):
+            chunk = rows[i:i + STATEMENT_ROWS]
+            c.execute(replace_sql(table, columns, len(chunk)),
+                      [v for row in chunk for v in row])
+    db.commit()
+
+
+def write_load(db, table, columns, rows):
+    fd, filename = tempfile.mkstemp(prefix='results-', suffix='.tsv')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for row in rows:
+                out.write('\t'.join(_field(v) for v in row) + '\n')
+        with closing(db.cursor()) as c:
+            c.execute(load_sql(table, columns), (filename,))
+        db.commit()
+    finally:
+        os.remove(filename)
+
+
+class MySQLSink(object):
+    """Writes rows to a table. The connection is made in the writer process.
+
+    Arguments:
+        connect:    function returning a database connection
+        table:      table to store the rows in
+        columns:    column names, in the order of the values of a row
+        method:     'insert' or 'load'
+    """
+
+    def __init__(self, connect, table, columns, method='insert'):
+        if method not in METHODS:
+            raise ValueError("Unknown write method: %s" % method)
+        self.connect = connect
+        self.table = table
+        self.columns = tuple(columns)
+        self.method = method
+        self.db = None
+
+    def open(self):
+        self.db = self.connect()
+
+    def write(self, rows):
+        write = write_load if self.method == 'load' else write_insert
+        write(self.db, self.table, self.columns, rows)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+
+class ResultWriter(object):
+    """Starts a process that passes the rows put on its queue to a sink; see
+    the module docstring.
+
+    Arguments:
+        sink:       MySQLSink, NpzSink, or any object with open(), write(rows),
+                    flush() and close() (called in the writer process)
+        complete:   function (rows, whole) of the rows of a group, returning
+                    the rows to store (called in the writer process); whole
+                    is False for the parts of a group that never completed
+        batch_rows: rows per write
+        flush_secs: write a partial batch after this long without new rows
+        queue_size: number of puts that can wait before put() blocks
+    """
+
+    def __init__(self, sink, complete=None, batch_rows=10000, flush_secs=5.0,
+                 queue_size=64):
+        self.sink = sink
+        self.complete = complete or (lambda rows, whole: rows)
+        self.batch_rows = batch_rows
+        self.flush_secs = flush_secs
+        self.queue = multiprocessing.Queue(queue_size)
+        # set by the writer process when it fails, though it keeps taking
+        # rows until closed
+        self.failed = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=self._run,
+                                               name='ResultWriter')
+        self.process.daemon = True
+        self.process.start()
+
+    def put(self, rows, group=None, parts=1):
+        """Queues rows to be stored. Rows of a group come in `parts` puts,
+        which can be empty; they are stored once all of them are in."""
+        if rows or group is not None:
+            self.queue.put((group, parts, rows))
+
+    def flush(self):
+        """Has the writer store everything queued so far (e.g. the sink's
+        partitions, for NpzSink)."""
+        self.queue.put(_FLUSH)
+
+    def check(self):
+        """Raises WriterError if the writer has failed or stopped (before
+        close())."""
+        if self.failed.is_set():
+            raise WriterError("The result writer failed; see its output "
+                "above")
+        if not self.process.is_alive():
+            raise WriterError("The result writer stopped (exit code %s); "
+                "see its output above" % self.process.exitcode)
+
+    def close(self):
+        """Stores the queued rows and stops the writer. Raises WriterError if
+        the writer failed."""
+        self.queue.put(None)
+        self.process.join()
+        if self.process.exitcode != 0:
+            raise WriterError("The result writer failed (exit code %s); "
+                "see its output above" % self.process.exitcode)
+
+    def _take(self, groups, group, parts, rows):
+        """Returns the rows ready to store: ungrouped rows, or a whole group
+        once its last part is in."""
+        if group is None:
+            return rows
+        held = groups.setdefault(group, [0, []])
+        held[0] += 1
+        held[1].extend(rows)
+        if held[0] < parts:
+            return []
+        del groups[group]
+        return self.complete(held[1], True)
+
+    def _run(self):
+        batch = []
+        groups = {}
+        stored = writes = 0
+        error = None
+        start = time.time()
+        try:
+            self.sink.open()
+        except Exception as e:
+            error = e
+            self.failed.set()
+            print("<ResultWriter> Failed to open %s: %s: %s" %
+                (type(self.sink).__name__, type(e).__name__, e))
+        while True:
+            try:
+                message = self.queue.get(timeout=self.flush_secs)
+            except Queue.Empty:
+                message = ()
+            done = message is None
+            flush = done or message == _FLUSH
+            idle = message == ()
+            if flush and groups:
+                # parts that never came: store what there is
+                print("<ResultWriter> Storing %d incomplete groups" %
+                    len(groups))
+                for held in groups.itervalues():
+                    batch.extend(self.complete(held[1], False))
+                groups = {}
+            elif not flush and not idle:
+                try:
+                    batch.extend(self._take(groups, *message))
+                except Exception as e:
+                    if error is None:
+                        error = e
+                        self.failed.set()
+                        print("<ResultWriter> Failed to complete a group: "
+                            "%s: %s" % (type(e).__name__, e))
+            if flush or idle or len(batch) >= self.batch_rows:
+                # after a failure, keep taking rows so workers don't block
+                if error is None:
+                    try:
+                        if batch:
+                            self.sink.write(batch)
+                            stored += len(batch)
+                            writes += 1
+                        if flush:
+                            self.sink.flush()
+                    except Exception as e:
+                        error = e
+                        self.failed.set()
+                        print("<ResultWriter> Failed to store %d rows: %s: %s"
+                            % (len(batch), type(e).__name__, e))
+                batch = []
+            if done:
+                break
+        try:
+            self.sink.close()
+        except Exception as e:
+            if error is None:
+                error = e
+                self.failed.set()
+                print("<ResultWriter> Failed to close %s: %s: %s" %
+                    (type(self.sink).__name__, type(e).__name__, e))
+        print("<ResultWriter> Stored %d rows in %d writes (%.1fs)" %
+            (stored, writes, time.time() - start))
+        if error is not None:
+            raise SystemExit(1)
@@ -0,0 +1,174 @@
+# Copyright 2012 by Erik Clarke. All rights reserved.
+"""On-disk cache of parsed GEO records.
+
+Parsing a GDS file, converting it to a NumericDataset and filtering it takes
+far longer than reading back the result, and every job on the same dataset
+(enrichment, then FDR correction, for each ontology) repeats it. This caches
+the filtered, log2-transformed matrix (and its probes, header, factors and
+metadata) as .npy files, keyed on a hash of the SOFT file and on the
+filter/transform parameters, so changing either one misses the cache. The
+matrix is memory-mapped when read back.
+
+Platform (GPL) records are cached whole, pickled.
+
+The cache is capped in size (max_bytes); once over, the least recently used
+entries are removed.
+
+Example:
+>> nset = fetch_numeric("GDS1962", destdir='data')  # parses and caches
+>> nset = fetch_numeric("GDS1962", destdir='data')  # reads from the cache
+"""
+
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import cPickle as pickle
+import numpy
+
+from __init__ import fetch, _get_remote
+from Records import NumericDataset
+
+CACHEDIR = 'data/cache'
+MAX_BYTES = 10 * 2 ** 30
+
+_arrays = ('matrix', 'probes', 'header')
+
+
+def _source(accn_or_file, destdir, verbose):
+    if os.path.isfile(accn_or_file):
+        return accn_or_file
+    return _get_remote(accn_or_file, destdir, 'full', verbose)
+
+
+def file_hash(filename, blocksize=2 ** 20):
+    """Returns the SHA-1 hex digest of a file's contents."""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def _entry(cachedir, filename, *params):
+    """Returns the cache directory for a source file and parameters."""
+    name = os.path.basename(filename).split('.')[0]
+    key = '-'.join([name, file_hash(filename)[:16]] +
+                   [re.sub(r'\W+', '_', str(p)) for p in params])
+    return os.path.join(cachedir, key)
+
+
+def _write_entry(path, write):
+    """Writes an entry through a temporary directory, moved into place once
+    complete, so concurrent jobs never see a partial entry."""
+    cachedir = os.path.dirname(path)
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    tmp = tempfile.mkdtemp(dir=cachedir, prefix='.tmp-')
+    try:
+        write(tmp)
+        os.rename(tmp, path)
+    except OSError:
+        # another job got there first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _touch(path):
+    os.utime(path, None)
+
+
+def _size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def evict(cachedir=CACHEDIR, max_bytes=MAX_BYTES):
+    """Removes the least recently used entries until the cache is no larger
+    than max_bytes. Returns the number of entries removed."""
+    if not os.path.isdir(cachedir):
+        return 0
+    entries = [os.path.join(cachedir, x) for x in os.listdir(cachedir)
+               if not x.startswith('.')]
+    entries = sorted((os.path.getmtime(x), _size(x), x) for x in entries)
+    total = sum(x[1] for x in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+def fetch_numeric(accn_or_file, destdir=None, cachedir=CACHEDIR,
+                  filter_fn=numpy.median, log2=True, dtype=numpy.float64,
+                  max_bytes=MAX_BYTES, verbose=True):
+    """Returns the dataset as a filtered (and log2 transformed) NumericDataset,
+    i.e. fetch(accn_or_file, numeric=True).filter(filter_fn).log2xform(),
+    reading it from the cache if it was made before.
+
+    Arguments:
+        filter_fn:  passed to NumericDataset.filter; part of the cache key
+        log2:       log2 transform the matrix (if not done already)
+        dtype:      numpy dtype of the matrix
+        max_bytes:  size limit of the cache
+    """
+    filename = _source(accn_or_file, destdir, verbose)
+    path = _entry(cachedir, filename, 'numeric', filter_fn.__name__,
+                  'log2' if log2 else 'raw', numpy.dtype(dtype).name)
+    info = os.path.join(path, 'info.pkl')
+    if os.path.isfile(info):
+        if verbose:
+            print "Found cached dataset at ", path
+        _touch(path)
+        with open(info, 'rb') as f:
+            info = pickle.load(f)
+        arrays = dict((a, numpy.load(os.path.join(path, a + '.npy'),
+                                     mmap_mode='r' if a == 'matrix' else None))
+                      for a in _arrays)
+        return NumericDataset.from_arrays(matrix=arrays['matrix'],
+            probes=arrays['probes'], header=arrays['header'], **info)
+
+    nset = fetch(filename, numeric=True, dtype=dtype, verbose=verbose)
+    nset.filter(filter_fn)
+    if log2:
+        nset.log2xform()
+
+    def write(tmp):
+        for a in _arrays:
+            numpy.save(os.path.join(tmp, a + '.npy'), getattr(nset, a))
+        with open(os.path.join(tmp, 'info.pkl'), 'wb') as f:
+            pickle.dump({'id': nset.id, 'factors': nset.factors,
+                         'meta': nset.meta, 'log2xformed': nset.log2xformed(),
+                         'filtered': nset.filtered()}, f, 2)
+    _write_entry(path, write)
+    evict(cachedir, max_bytes)
+    return nset
+
+
+def fetch_record(accn_or_file, destdir=None, cachedir=CACHEDIR,
+                 max_bytes=MAX_BYTES, verbose=True):
+    """Returns the GEO record (e.g. a GPL platform), parsed or read from the
+    cache."""
+    filename = _source(accn_or_file, destdir, verbose)
+    path = _entry(cachedir, filename, 'record')
+    pkl = os.path.join(path, 'record.pkl')
+    if os.path.isfile(pkl):
+        if verbose:
+            print "Found cached record at ", path
+        _touch(path)
+        with open(pkl, 'rb') as f:
+            return pickle.load(f)
+
+    record = fetch(filename, verbose=verbose)
+
+    def write(tmp):
+        with open(os.path.join(tmp, 'record.pkl'), 'wb') as f:
+            pickle.dump(record, f, 2)
+    _write_entry(path, write)
+    evict(cachedir, max_bytes)
+    return record
@@ -20,8 +20,9 @@ import urllib
 import tempfile
 import gzip
 import time
+import numpy
 
-from Records import Record, Dataset, Series
+from Records import Record, Dataset, Series, NumericDataset
 
 # -- Code to retrieve GEO records from NCBI  -- #
 
@@ -86,16 +87,27 @@ def _get_remote(accn, destdir, amount, verbose, tries=0):
         return downloaded
 
 
-def fetch(accn_or_file, destdir=None, amount='full', verbose=True, tries=0):
+def fetch(accn_or_file, destdir=None, amount='full', verbose=True, tries=0,
+          numeric=False, dtype=numpy.float64):
+    """Returns the GEO record for a local file or accession number.
+
+    Arguments:
+        numeric:    for datasets, return a NumericDataset built directly from
+                    the parsed values (skipping the copy made by to_numeric())
+        dtype:      the numpy dtype of the numeric matrix (if numeric)
+    """
     if os.path.isfile(accn_or_file):
         geo = accn_or_file
     else:
         geo = _get_remote(accn_or_file, destdir, amount, verbose)
 
     if geo.endswith('.gz'):
-        return parse(gzip.open(geo))
+        record = parse(gzip.open(geo), verbose)
     else:
-        return parse(open(geo))
+        record = parse(open(geo), verbose)
+    if numeric and isinstance(record, Dataset):
+        return NumericDataset(record, copy=False, dtype=dtype)
+    return record
 
 
 # -- Code to parse the four GEO record types -- #
@@ -112,96 +124,222 @@ def _read_key_value(line):
     return key, value
 
 
-def _loop(fn):
-    def loop(record, lines):
-        for line in lines:
-            line = line.strip('\n\r')
-            fn(record, line)
-        return record
-    return loop
+_table_marker = re.compile(r'![a-z]+_table_(begin|end)', re.I)
+_table_begin = re.compile(r'![a-z]+_table_begin', re.I)
+_key_prefix = re.compile(r'^[a-z]+_')
+_database = re.compile(r'[!\^]Database', re.I)
+_sample_col = re.compile(r'GSM\d+$')
 
+# rows to allocate for a dataset table if it doesn't give its feature_count
+_DEFAULT_ROWS = 1024
+# text of a dataset table converted at a time (about 1000 rows of 100 samples)
+_CHUNK_BYTES = 1 << 20
 
-@_loop
-def _add_attributes(record, line):
-    if not re.match(r'![a-z]+_table_(begin|end)', line, re.I):
+
+def _add_attribute(record, line):
+    if not _table_marker.match(line):
         key, value = _read_key_value(line)
-        key = re.sub(r'^[a-z]+_', '', key)  # strip first part (redundant)
+        key = _key_prefix.sub('', key)  # strip first part (redundant)
         record.meta[key] = value
 
 
-@_loop
-def _add_col_descriptions(record, line):
+def _add_col_description(record, line):
     key, value = _read_key_value(line)
     record.columns[key] = {'description': value}
 
 
-@_loop
-def _add_table_rows(record, line):
+def _add_table_row(record, line):
+    record.table.append(line.split('\t'))
+
+
+def _set_dataset_header(record, row):
+    record.header = row
+    samples = [x for x in row if _sample_col.match(x)]
+    record._end = row.index(samples[-1]) + 1 if samples else len(row)
+
+
+def _add_dataset_row(record, line):
+    """Adds a row of a dataset's table straight into its numeric buffer
+    (record.values), keeping only the row's ids as strings. The first row is
+    the header."""
     row = line.split('\t')
-    record.table.append(row)
+    if not record.header:
+        _set_dataset_header(record, row)
+        rows = int(record.meta.get('feature_count') or _DEFAULT_ROWS)
+        record.values = numpy.empty((rows, record._end - 2))
+        record.nulls = numpy.zeros(rows, dtype=bool)
+        return
+    i = len(record.ids)
+    _reserve(record, i + 1)
+    record.ids.append(row[:2])
+    values = row[2:record._end]
+    try:
+        record.values[i] = values
+        record.nulls[i] = False
+    except ValueError:
+        # nulls or other non-numeric values; converted one at a time
+        record.values[i] = [_tofloat(x) for x in values]
+        record.nulls[i] = 'null' in values
+
+
+def _reserve(record, rows):
+    """Grows the dataset's numeric buffer (by doubling) to hold `rows` rows."""
+    if rows > len(record.values):
+        size = max(rows, 2 * len(record.values))
+        record.values = numpy.resize(record.values,
+            (size, record.values.shape[1]))
+        record.nulls = numpy.resize(record.nulls, size)
+
+
+def _add_dataset_rows(record, rows):
+    """Adds rows (after the header) of a dataset's table into its numeric
+    buffer, converting all their values in one vectorized call
+    (numpy.fromstring). Falls back to _add_dataset_row for rows with values
+    other than numbers and 'null', or ragged rows."""
+    width = record._end - 2
+    trailing = len(record.header) - record._end
+    try:
+        split = [row.split('\t', 2) for row in rows]
+        values = [x[2] for x in split]
+        if trailing:
+            values = [x.rsplit('\t', trailing)[0] for x in values]
+        matrix = numpy.fromstring('\t'.join(values).replace('null', 'nan'),
+                                  sep='\t')
+        if matrix.size != len(values) * width:
+            raise ValueError("Ragged or non-numeric dataset table")
+    except (ValueError, IndexError):
+        for row in rows:
+            _add_dataset_row(record, row)
+        return
+    i = len(record.ids)
+    n = i + len(rows)
+    _reserve(record, n)
+    record.values[i:n] = matrix.reshape((len(rows), width))
+    record.nulls[i:n] = ['null' in x for x in values]
+    record.ids.extend(x[:2] for x in split)
+
+
+def _read_dataset_table(record, lines):
+    """Reads a dataset's data table, from the line after !dataset_table_begin
+    up to !dataset_table_end, into the numeric buffer allocated from its
+    feature_count (see _add_dataset_row). Rows are converted in chunks of
+    about _CHUNK_BYTES of text (see _add_dataset_rows) rather than one at a
+    time, and only a chunk of the table's text is held at once.
+    """
+    record.header = []
+    chunk = []
+    size = 0
+    for line in lines:
+        line = line.strip('\n\r')
+        if not line:
+            continue
+        if _table_marker.match(line):
+            break
+        if not record.header:
+            _add_dataset_row(record, line)
+            continue
+        chunk.append(line)
+        size += len(line)
+        if size >= _CHUNK_BYTES:
+            _add_dataset_rows(record, chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        _add_dataset_rows(record, chunk)
 
 
-def _filter(source, regex, invert=False):
-    if not invert:
-        return [x for x in source if re.match(regex, x, re.I)]
-    else:
-        return [x for x in source if not re.match(regex, x, re.I)]
+def _tofloat(x):
+    try:
+        return float(x)
+    except ValueError:
+        return float('nan')
+
+
+def _finish_dataset(record, subsets):
+    """Trims the dataset's numeric buffer and files each subset's samples
+    under its factor."""
+    if record.values is not None:
+        n = len(record.ids)
+        record.values = record.values[:n]
+        record.nulls = record.nulls[:n]
+    for subset in subsets:
+        factor = subset.meta['type']
+        description = subset.meta['description']
+        samples = subset.meta['sample_id'].split(',')
+        record.factors[factor][description] = samples
+        for sample in samples:
+            # add subset desc to each sample's column
+            record.columns[sample].update({factor: description})
+    return record
 
 
 def _parse(source):
     """Iteratively reads the source (a handle or list of lines) for GEO records,
     returning each record as it is parsed.
 
+    The source is read once, line by line: each line is dispatched on its
+    first character to the entity it belongs to, and the data table of a
+    DATASET is read as a block straight into a numeric array rather than a
+    list of rows (see _read_dataset_table).
+
     For most purposes, use the public method 'parse()' for expected behavior.
     """
-    source = _filter(source, r'[!\^]Database', invert=True)
-    record = None
+    source = iter(source)
+    record = None    # the record to be yielded
+    entity = None    # the entity lines are currently added to
+    subsets = []
     for line in source:
+        line = line.strip('\n\r')
         if not line:
             continue
         c = line[0]
         if c == '^':
-            if record:
-                yield record
+            if _database.match(line):
+                entity = None
+                continue
             type, id = _read_key_value(line)
-            if type == 'SERIES':
-                record = Series(id)
-                meta = _filter(source, r'!Series')
-                rest = _filter(source, r'[!\^]Series', invert=True)
-                _add_attributes(record, source)
-                for subrecord in _parse(rest):
-                    if subrecord.type == 'PLATFORM':
-                        record.platforms.append(subrecord)
-                    elif subrecord.type == 'SAMPLE':
-                        record.samples.append(subrecord)
-            elif type == 'DATASET':
-                record = Dataset(id)
-                columns = _filter(source, r'#')
-                table = _filter(source, r'[^!\^#]')
-                meta = _filter(source, r'!dataset')
-                subsets = _filter(source, r'[!\^]subset')
-
-                _add_col_descriptions(record, columns)
-                _add_table_rows(record, table)
-                _add_attributes(record, meta)
-
-                for subset in _parse(subsets):
-                    factor = subset.meta['type']
-                    description = subset.meta['description']
-                    samples = subset.meta['sample_id'].split(',')
-                    record.factors[factor][description] = samples
-                    for sample in samples:
-                        # add subset desc to each sample's column
-                        record.columns[sample].update({factor: description})
+            if type == 'DATASET' and isinstance(record, Dataset):
+                # the table section of a dataset repeats its header
+                entity = record
+            elif type == 'SUBSET' and isinstance(record, Dataset):
+                entity = Record(type, id)
+                subsets.append(entity)
+            elif (type in ('PLATFORM', 'SAMPLE') and
+                    isinstance(record, Series)):
+                entity = Record(type, id)
+                if type == 'PLATFORM':
+                    record.platforms.append(entity)
+                else:
+                    record.samples.append(entity)
             else:
-                record = Record(type, id)
+                if record:
+                    if isinstance(record, Dataset):
+                        _finish_dataset(record, subsets)
+                    yield record
+                subsets = []
+                if type == 'SERIES':
+                    record = Series(id)
+                elif type == 'DATASET':
+                    record = Dataset(id)
+                else:
+                    record = Record(type, id)
+                entity = record
+        elif entity is None:
+            continue
         elif c == '!':
-            _add_attributes(record, [line])
+            if isinstance(entity, Dataset) and _table_begin.match(line):
+                _read_dataset_table(entity, source)
+            else:
+                _add_attribute(entity, line)
         elif c == '#':
-            _add_col_descriptions(record, [line])
+            _add_col_description(entity, line)
+        elif isinstance(entity, Dataset):
+            _add_dataset_row(entity, line)
         else:
-            _add_table_rows(record, [line])
+            _add_table_row(entity, line)
     if record:
+        if isinstance(record, Dataset):
+            _finish_dataset(record, subsets)
         yield record
 
 
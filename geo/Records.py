@@ -6,6 +6,7 @@ http://www.ncbi.nlm.nih.gov/geo/
 """
 
 
+import os
 import re
 from collections import defaultdict
 from copy import deepcopy
@@ -47,6 +48,20 @@ def _pad(string, pad_to=20, justify='left'):
         return string + spaces
 
 
+def _fdr_bh(pvals):
+    """Benjamini-Hochberg q-values for each column of a (probes x tests) array
+    of p-values; the same as multitest.fdrcorrection applied per column."""
+    n = pvals.shape[0]
+    columns = numpy.arange(pvals.shape[1])
+    order = numpy.argsort(pvals, axis=0)
+    ecdf = numpy.arange(1, n + 1) / float(n)
+    ranked = pvals[order, columns] / ecdf[:, numpy.newaxis]
+    ranked = numpy.minimum.accumulate(ranked[::-1], axis=0)[::-1]
+    qvals = numpy.empty_like(ranked)
+    qvals[order, columns] = numpy.minimum(ranked, 1)
+    return qvals
+
+
 class SOFTRecord(object):
     """Base class for SOFT-format file representations (GDS, GSE, GSM, and GPL).
 
@@ -105,6 +120,7 @@ class Record(SOFTRecord):
         super(Record, self).__init__(type, id)
         self.table = []
         self.columns = {}
+        self._entrez_index = None
 
     def print_table(self, length=20, max_width=80, col_width=20):
         """Prints a nicely-formatted overview of the data table.
@@ -151,16 +167,121 @@ class Record(SOFTRecord):
         self.print_table()
         self.print_columns()
 
+    def entrez_index(self):
+        """Returns the probe -> Entrez Gene index of this (platform) record's
+        table, building it on first use. The index is saved next to the
+        record's source file (<source>.entrez.npz) and loaded from there
+        while it's newer than the source."""
+        if getattr(self, '_entrez_index', None) is None:
+            cache = self.source + '.entrez.npz' if self.source else None
+            if (cache and os.path.isfile(cache) and
+                    os.path.getmtime(cache) >= os.path.getmtime(self.source)):
+                self._entrez_index = EntrezIndex.load(cache)
+            else:
+                self._entrez_index = EntrezIndex(self.table)
+                if cache:
+                    try:
+                        self._entrez_index.save(cache)
+                    except IOError:
+                        pass
+        return self._entrez_index
+
+
+class EntrezIndex(object):
+    """Maps the probes of a platform table to the Entrez Gene ids in its
+    ENTREZ_GENE_ID (or GENE) column, so mapping a list of probes is an array
+    lookup rather than a scan of the table.
+
+    Cells naming several genes ('1234 /// 5678') are split, and kept apart
+    from the single-gene probes; see entrez() for how they are handled.
+
+    Attributes:
+        column:     name of the Entrez Gene id column
+        probes:     the probe ids (first column), in table order
+        offsets,
+        genes:      CSR-style Entrez ids of each probe, in table order
+        multi:      True for probes whose cell names more than one gene
+    """
+
+    def __init__(self, table=None):
+        if table is None:
+            return
+        if 'ENTREZ_GENE_ID' in table[0]:
+            self.column = 'ENTREZ_GENE_ID'
+        elif 'GENE' in table[0]:
+            self.column = 'GENE'
+        else:
+            raise ValueError('Cannot find Entrez mappings for this platform!')
+        col = table[0].index(self.column)
+        cells = [row[col] if len(row) > col else '' for row in table[1:]]
+        genes = [[g.strip() for g in cell.split('///') if g.strip()]
+                 for cell in cells]
+        self.probes = array([row[0] for row in table[1:]], dtype=str)
+        self.offsets = numpy.zeros(len(genes) + 1, dtype=numpy.int64)
+        self.offsets[1:] = numpy.cumsum([len(g) for g in genes])
+        self.genes = array([g for gs in genes for g in gs], dtype=str)
+        self.multi = array(['/' in cell for cell in cells], dtype=bool)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            numpy.savez(f, column=self.column, probes=self.probes,
+                        offsets=self.offsets, genes=self.genes, multi=self.multi)
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        data = numpy.load(filename)
+        index.column = str(data['column'])
+        for name in ('probes', 'offsets', 'genes', 'multi'):
+            setattr(index, name, data[name])
+        return index
+
+    def rows(self, probes):
+        """Returns a boolean array over the table rows, True for the rows of
+        the given probes."""
+        return numpy.in1d(self.probes, array(list(probes), dtype=str))
+
+    def entrez(self, rows=None, multi='drop'):
+        """Returns the Entrez ids of the selected rows, in table order.
+
+        Arguments:
+            rows:   a boolean array over the rows (see rows()); default all
+            multi:  what to do with probes mapping to several genes:
+                    'drop' them (as map2entrez always has), or 'split' them
+                    into each of their genes
+        """
+        counts = numpy.diff(self.offsets)
+        selected = numpy.ones(len(counts), dtype=bool) if rows is None else rows
+        if multi == 'drop':
+            selected = selected & (counts == 1) & ~self.multi
+            return self.genes[self.offsets[:-1][selected]].tolist()
+        elif multi == 'split':
+            counts = numpy.where(selected, counts, 0)
+            starts = numpy.repeat(self.offsets[:-1], counts)
+            within = (numpy.arange(counts.sum()) -
+                      numpy.repeat(numpy.cumsum(counts) - counts, counts))
+            return self.genes[starts + within].tolist()
+        raise ValueError("multi must be 'drop' or 'split'")
+
 
 class Dataset(Record):
     """Represents a GEO Dataset (GDS) record.
 
+    The data table is parsed straight into a numeric array (values), keeping
+    only the header and the row ids as strings; `table` rebuilds the usual
+    list of rows from these when it's asked for.
+
     Attributes:
         id:      entity id (GEO accession)
         type:    entity type
         meta:    metadata information for the record {key:value}
         table:   list of rows, split by tabs. First row is the header.
                  [header, row1, row2, ...]
+        header:  the header row of the data table
+        ids:     the first two columns (ID_REF, IDENTIFIER) of each table row
+        values:  numpy array of the sample columns of each table row, with
+                 non-numeric values as nan
+        nulls:   boolean array, True for rows containing 'null' values
         columns: column names, descriptions, and factor subsets.
                  {colname: {description:'', factor1:'', factor2:'', ...}}
         factors: factors and their subsets
@@ -168,11 +289,30 @@ class Dataset(Record):
         _matrix: data table as a numpy matrix for numerical analysis
     """
     def __init__(self, id):
+        self._table = None
         super(Dataset, self).__init__("DATASET", id)
         self.factors = defaultdict(dict)
+        self.header = []
+        self.ids = []
+        self.values = None
+        self.nulls = None
         self._platform = None
         self._matrix = None
 
+    @property
+    def table(self):
+        if not self._table and self.values is not None:
+            def fmt(row, null):
+                return ['null' if null and x != x else repr(x) for x in row]
+            self._table = [list(self.header)] + [
+                ids + fmt(row, null) for ids, row, null
+                in zip(self.ids, self.values.tolist(), self.nulls)]
+        return self._table
+
+    @table.setter
+    def table(self, value):
+        self._table = value
+
     def print_columns(self, factor=None, subset=None):
         """Readable display of data columns, with associated description,
         factor, and subset.
@@ -208,7 +348,14 @@ class Dataset(Record):
                         [default = False]
         """
         # memoize the matrix (as it takes some time to generate)
-        if self._matrix != None and not refresh:
+        if self._matrix is not None and not refresh:
+            return self._matrix
+
+        if omitNulls:
+            print "converting to numpy array and omitting probes containing " + nullVal
+        if self.values is not None and nullVal == 'null':
+            self._matrix = (self.values[numpy.invert(self.nulls)] if omitNulls
+                            else self.values)
             return self._matrix
 
         def tofloat(x):
@@ -216,8 +363,6 @@ class Dataset(Record):
                 return float(x)
             except ValueError:
                 return float('nan')
-        if omitNulls:
-            print "converting to numpy array and omitting probes containing " + nullVal
         header = self.table[0]
         samples = [x for x in header if re.match(r'GSM\d+$', x)]
         end_samples = header.index(samples[len(samples) - 1])
@@ -266,15 +411,31 @@ class NumericDataset(SOFTRecord):
         factors:    the original factor information from the dataset
     """
 
-    def __init__(self, dataset=None):
+    def __init__(self, dataset=None, copy=True, dtype=None):
+        """Arguments:
+            dataset:    the Dataset to convert
+            copy:       copy the dataset's matrix and metadata, rather than
+                        taking them over (fine if the dataset is thrown away)
+            dtype:      convert the matrix to this numpy dtype (e.g. float32)
+        """
         super(NumericDataset, self).__init__("NUMERIC DATASET", dataset.id)
-        self.matrix = deepcopy(dataset.matrix())
-        self.probes = array([x[:2] for x in dataset.table[1:]])
-        self.header = array(dataset.table[0])
-        self.factors = deepcopy(dataset.factors) if dataset else None
-        self.meta = deepcopy(dataset.meta) if dataset else None
+        _copy = deepcopy if copy else (lambda x: x)
+        self.matrix = _copy(dataset.matrix())
+        if dtype is not None:
+            self.matrix = self.matrix.astype(dtype)
+        # matrix() leaves out rows with nulls; the probes have to match it
+        if dataset.values is not None:
+            self.probes = array(dataset.ids)[numpy.invert(dataset.nulls)]
+            self.header = array(dataset.header)
+        else:
+            self.probes = array([x[:2] for x in dataset.table[1:]
+                                 if 'null' not in x])
+            self.header = array(dataset.table[0])
+        self.factors = _copy(dataset.factors) if dataset else None
+        self.meta = _copy(dataset.meta) if dataset else None
         self._log2xformed = False
         self._filtered = False
+        self._subset_masks = {}
         # heuristic for determining if already log2 transformed:
         print "checking if matrix has been normalized..."
         if dataset.meta['value_type'] == 'count':
@@ -293,6 +454,23 @@ class NumericDataset(SOFTRecord):
             self.log2xform()
         """
 
+    @classmethod
+    def from_arrays(cls, id, matrix, probes, header, factors, meta,
+                    log2xformed=False, filtered=False):
+        """Returns a NumericDataset made from its parts (as saved by
+        Cache.py), without a Dataset to convert."""
+        nset = cls.__new__(cls)
+        SOFTRecord.__init__(nset, "NUMERIC DATASET", id)
+        nset.matrix = matrix
+        nset.probes = probes
+        nset.header = header
+        nset.factors = factors
+        nset.meta = meta
+        nset._log2xformed = log2xformed
+        nset._filtered = filtered
+        nset._subset_masks = {}
+        return nset
+
     def log2xform(self):
         """Returns this dataset with the binary log applied to each value in
         the data matrix.
@@ -325,8 +503,8 @@ class NumericDataset(SOFTRecord):
         """
         if not self.filtered():
             level = fn(self.matrix)
-            above = array([max(x) > level for x in self.matrix])
-            print "Filter: removing %d/%d probes." % (len([x for x in above if not x]), len(self.matrix))
+            above = numpy.max(self.matrix, axis=1) > level
+            print "Filter: removing %d/%d probes." % (len(above) - numpy.count_nonzero(above), len(self.matrix))
             self.matrix = self.matrix[above, :]
             self.probes = self.probes[above, :]
             self._filtered = True
@@ -335,6 +513,16 @@ class NumericDataset(SOFTRecord):
     def filtered(self):
         return self._filtered
 
+    def subset_mask(self, _subset, _factor):
+        """Returns a boolean array over the matrix columns, True for the
+        samples in the subset. Masks are computed once per subset."""
+        key = (_factor, _subset)
+        if key not in self._subset_masks:
+            samples = self.factors[_factor][_subset]
+            columns = self.header[2:2 + self.matrix.shape[1]]
+            self._subset_masks[key] = numpy.in1d(columns, samples)
+        return self._subset_masks[key]
+
     def diffexpressed(self, _subset, _factor, qval_limit, verbose=True):
         """Returns an array of probes that are differentially expressed according
         to the following method:
@@ -354,23 +542,72 @@ class NumericDataset(SOFTRecord):
             print("Warning: Finding differentially expressed genes on an unfiltered matrix may fail. Run dataset.filter().")
 
         matrix = self.matrix
-        probes = self.probes
-        samples = self.factors[_factor][_subset]
+        inA = self.subset_mask(_subset, _factor)
 
-        inA = array([x in samples for x in self.header[2:]])
-        A = numpy.transpose(matrix[:, inA])
-        B = numpy.transpose(matrix[:, numpy.invert(inA)])
-
-        t, pvals = stats.ttest_ind(A, B)
+        # probes in rows, so the test runs along axis 1
+        t, pvals = stats.ttest_ind(matrix[:, inA], matrix[:, ~inA], axis=1)
         rejected, qvals = multitest.fdrcorrection(pvals, alpha=qval_limit)
 
-        # probe values are [probe_name, entrez_id] form (hence x[0])
-        diffexp = [x[0] for i, x in enumerate(probes) if qvals[i] < qval_limit]
+        # probe values are [probe_name, entrez_id] form (hence column 0)
+        diffexp = self.probes[qvals < qval_limit, 0].tolist()
         if verbose:
-            print("%d samples, %d differentially expressed genes in %s: %s" % (len([x for x in inA if x]), len(diffexp), _factor, _subset))
+            print("%d samples, %d differentially expressed genes in %s: %s" % (numpy.count_nonzero(inA), len(diffexp), _factor, _subset))
         return diffexp
 
 
+    def diffexpressed_all(self, _factor, qval_limit, verbose=True):
+        """Finds the differentially expressed probes of every subset of a
+        factor at once, by the same method as diffexpressed(): each subset's
+        samples are t-tested against the rest, and probes with a
+        Benjamini-Hochberg q-value under the cutoff are kept.
+
+        The per-probe sums and sums of squares of each subset come out of one
+        matrix product, and every subset's t statistics, p-values and q-values
+        are derived from them together, rather than slicing the matrix and
+        running a separate test per subset.
+
+        Returns a dict of {subset: boolean array over the probes}, e.g.
+        self.probes[masks[subset], 0] are the subset's probe names.
+
+        Arguments:
+            _factor:    the factor whose subsets are tested
+            qval_limit: the FDR q-value representing the upper limit for results
+        """
+        if not self.filtered():
+            print("Warning: Finding differentially expressed genes on an unfiltered matrix may fail. Run dataset.filter().")
+
+        subsets = list(self.factors[_factor])
+        # (samples x subsets) indicator matrix
+        members = numpy.column_stack([self.subset_mask(s, _factor)
+                                      for s in subsets]).astype(numpy.float64)
+        # centering each probe keeps the sums of squares well-conditioned
+        matrix = self.matrix - numpy.mean(self.matrix, axis=1)[:, numpy.newaxis]
+        sums = matrix.dot(members)
+        squares = (matrix ** 2).dot(members)
+        total = matrix.sum(axis=1)[:, numpy.newaxis]
+        total_sq = (matrix ** 2).sum(axis=1)[:, numpy.newaxis]
+
+        nA = members.sum(axis=0)
+        nB = matrix.shape[1] - nA
+        mA = sums / nA
+        mB = (total - sums) / nB
+        ssA = squares - sums * mA
+        ssB = (total_sq - squares) - (total - sums) * mB
+        df = nA + nB - 2
+        # pooled variance, as in stats.ttest_ind (equal_var=True)
+        svar = (ssA + ssB) / df
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t = (mA - mB) / numpy.sqrt(svar * (1.0 / nA + 1.0 / nB))
+        pvals = 2 * stats.t.sf(numpy.abs(t), df)
+        qvals = _fdr_bh(pvals)
+
+        masks = {}
+        for i, subset in enumerate(subsets):
+            masks[subset] = qvals[:, i] < qval_limit
+            if verbose:
+                print("%d samples, %d differentially expressed genes in %s: %s" % (nA[i], numpy.count_nonzero(masks[subset]), _factor, subset))
+        return masks
+
     def diffexpressed_alt(self, _subset, _factor, pval_cutoff, d_avg_cutoff, verbose=True, more=False):
         """Returns an array of probes that are differentially expressed according
         to the following method:
@@ -394,27 +631,23 @@ class NumericDataset(SOFTRecord):
         """
 
         matrix = self.matrix
-        probes = self.probes
-        samples = self.factors[_factor][_subset]
-        nprobes = range(len(matrix))
-
-        inA = array([x in samples for x in self.header[2:]])
+        inA = self.subset_mask(_subset, _factor)
         A = numpy.transpose(matrix[:, inA])
-        B = numpy.transpose(matrix[:, numpy.invert(inA)])
+        B = numpy.transpose(matrix[:, ~inA])
         mA = numpy.mean(A, axis=0)
         mB = numpy.mean(B, axis=0)
 
         t, pvals = stats.ttest_ind(A, B)
         # boolean arrays (T if significant, F otherwise) for the cutoffs
-        sig_pvals = [x < pval_cutoff for x in pvals]
-        sig_diffs = [abs(mA[i] - mB[i]) > d_avg_cutoff for i in nprobes]
-        sig_union = array([sig_pvals[i] and sig_diffs[i] for i in nprobes])
-        diffexp = probes[sig_union, :]
+        sig_pvals = pvals < pval_cutoff
+        sig_diffs = numpy.abs(mA - mB) > d_avg_cutoff
+        sig_union = sig_pvals & sig_diffs
+        diffexp = self.probes[sig_union, :]
         if verbose:
-            print("%s samples, %s differentially expressed genes in %s: %s" % (len([x for x in inA if x]), len(diffexp), _factor, _subset))
+            print("%s samples, %s differentially expressed genes in %s: %s" % (numpy.count_nonzero(inA), len(diffexp), _factor, _subset))
         if more:
             return diffexp, pvals, (A, B, mA, mB), (sig_pvals, sig_diffs, sig_union)
         else:
-            return [x[0] for x in diffexp]
+            return diffexp[:, 0].tolist()
 
         
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times NumericDataset.filter and diffexpressed on random datasets of
+increasing size, against the per-probe Python loops they replaced.
+
+Usage: python benchmark.py [--no_legacy]
+"""
+import sys
+import time
+import numpy
+import scipy.stats as stats
+from statsmodels.stats import multitest
+
+from Records import NumericDataset
+
+PROBES = (1000, 10000, 50000)
+SAMPLES = (10, 100, 500)
+QVAL = 0.05
+
+
+def random_dataset(nprobes, nsamples, seed=0):
+    rand = numpy.random.RandomState(seed)
+    matrix = rand.lognormal(6, 1, size=(nprobes, nsamples))
+    # shift a tenth of the probes in the first subset
+    half = nsamples // 2
+    matrix[:nprobes // 10, :half] *= 2
+    samples = ['GSM%d' % i for i in xrange(nsamples)]
+    probes = numpy.array([['%d_at' % i, 'GENE%d' % i]
+                          for i in xrange(nprobes)])
+    header = numpy.array(['ID_REF', 'IDENTIFIER'] + samples)
+    factors = {'disease state': {'A': samples[:half], 'B': samples[half:]}}
+    return NumericDataset.from_arrays('GDS0', numpy.log2(matrix), probes,
+        header, factors, {}, log2xformed=True)
+
+
+def legacy_filter(nset, fn=numpy.median):
+    level = fn(nset.matrix)
+    above = numpy.array([max(x) > level for x in nset.matrix])
+    nset.matrix = nset.matrix[above, :]
+    nset.probes = nset.probes[above, :]
+
+
+def legacy_diffexpressed(nset, subset, factor, qval_limit):
+    samples = nset.factors[factor][subset]
+    inA = numpy.array([x in samples for x in nset.header[2:]])
+    A = numpy.transpose(nset.matrix[:, inA])
+    B = numpy.transpose(nset.matrix[:, numpy.invert(inA)])
+    t, pvals = stats.ttest_ind(A, B)
+    rejected, qvals = multitest.fdrcorrection(pvals, alpha=qval_limit)
+    return [x[0] for i, x in enumerate(nset.probes) if qvals[i] < qval_limit]
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+
+def main(legacy=True):
+    print("%8s %8s %12s %12s %12s %12s" % ('probes', 'samples', 'filter',
+        'legacy', 'diffexp', 'legacy'))
+    for nprobes in PROBES:
+        for nsamples in SAMPLES:
+            nset = random_dataset(nprobes, nsamples)
+            t_filter, _ = timed(nset.filter)
+            t_diff, new = timed(nset.diffexpressed, 'A', 'disease state',
+                QVAL, False)
+            if legacy:
+                old = random_dataset(nprobes, nsamples)
+                t_lfilter, _ = timed(legacy_filter, old)
+                t_ldiff, result = timed(legacy_diffexpressed, old, 'A',
+                    'disease state', QVAL)
+                assert result == new
+            else:
+                t_lfilter = t_ldiff = float('nan')
+            print("%8d %8d %12.4f %12.4f %12.4f %12.4f" % (nprobes, nsamples,
+                t_filter, t_lfilter, t_diff, t_ldiff))
+
+
+if __name__ == '__main__':
+    main(legacy='--no_legacy' not in sys.argv)
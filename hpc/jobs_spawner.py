@@ -9,7 +9,12 @@ be specified using the --config option.
 To be sure that the config file contains the correct fields, run with --dryrun first. This runs 
 through the entire script except for submitting the job to the cluster.
 
-Usage: python jobs_spawner <list of datasets> [--config CONFIG_FILE] [--dryrun]
+With --batch N, the datasets are grouped N to a job instead, each job running
+them all through one enrichment process (see enrichment.py --datasets) so the
+annotations are only loaded once per job. Use with a batch template and
+config (e.g. configs/batch.job.settings.cfg).
+
+Usage: python jobs_spawner <list of datasets> [--config CONFIG_FILE] [--batch N] [--dryrun]
 
 Author: eclarke@scripps.edu
 """
@@ -20,12 +25,13 @@ from ConfigParser import SafeConfigParser
 from argparse import ArgumentParser
 
 
-def spawn(gds, config, dryrun):
+def spawn(gds, config, dryrun, extra_args=None):
     pyscript = config.get('Job', 'pyscript')
     jobname = config.get('Job', 'name').format(gds=gds)
     template = open(config.get('Job', 'template')).read()
     args = dict(config.items('Template')+config.items('Job'))
     args['gds'] = gds
+    args.update(extra_args or {})
     outfile = config.get('Job', 'jobscript').format(gds=gds)
     
     script_file = create_job_script(template, args, outfile)
@@ -35,6 +41,16 @@ def spawn(gds, config, dryrun):
     return jobid, command
 
 
+def spawn_batch(batch, accessions, config, dryrun):
+    """Writes the accessions to a dataset list and spawns one job for them
+    all; the list file is passed to the template as {datasets}."""
+    name = 'batch%d' % batch
+    listfile = config.get('Job', 'datasets').format(gds=name)
+    with open(listfile, 'wb') as out:
+        out.write(''.join(accn + '\n' for accn in accessions))
+    return spawn(name, config, dryrun, {'datasets': listfile})
+
+
 def create_job_script(script, args, outfile):
     script = script.format(**args)
     script = script.format(**args) # repeat in case of nested format strings
@@ -49,6 +65,7 @@ def main():
     parser.add_argument('--dryrun', action='store_true', default=False, dest="dryrun", help="Create job script in jobs/ but do not launch on cluster.")
     parser.add_argument('-d', nargs='+', action='store', dest="datasets", help="One or more GEO dataset accessions")
     parser.add_argument('-f', action='store', dest="datasets_file", help="File listing GEO datasets, one per line", type=file)
+    parser.add_argument('--batch', action='store', dest="batch", type=int, default=0, help="Number of datasets to run in each job (default: one job per dataset)")
 
     args = parser.parse_args()
 
@@ -65,6 +82,13 @@ def main():
         parser.print_usage()
         return
 
+    if args.batch > 0:
+        for i in range(0, len(accessions), args.batch):
+            job, command = spawn_batch(i // args.batch,
+                accessions[i:i + args.batch], config, args.dryrun)
+            print "%s launched with command: '%s'" % (job, command)
+        return
+
     for i, accn in enumerate(accessions):
         job, command = spawn(accn, config, args.dryrun)
         print "%s launched with command: '%s'" % (job, command)
@@ -0,0 +1,69 @@
+-- Copies the results and shuffled tables (results_db_schema.sql) into the v2
+-- schema (results_v2_schema.sql, which must be loaded first). Rows already
+-- migrated are updated, so this can be run again after new results are
+-- stored, e.g.:
+--   mysql <db> < sql/results_v2_schema.sql
+--   mysql <db> < sql/migrate_results_v2.sql
+
+DELIMITER //
+
+DROP PROCEDURE IF EXISTS RunMigrationStep //
+CREATE PROCEDURE RunMigrationStep(IN _src VARCHAR(64), IN _sql TEXT)
+BEGIN
+    SET @step = REPLACE(_sql, '{src}', _src);
+    PREPARE step FROM @step;
+    EXECUTE step;
+    DEALLOCATE PREPARE step;
+END //
+
+DROP PROCEDURE IF EXISTS MigrateResultsV2 //
+CREATE PROCEDURE MigrateResultsV2(IN _src VARCHAR(64))
+BEGIN
+    CALL RunMigrationStep(_src,
+        'INSERT IGNORE INTO datasets (dataset)
+            SELECT DISTINCT dataset FROM {src}');
+    CALL RunMigrationStep(_src,
+        'INSERT IGNORE INTO subsets (dataset_id, factor, subset)
+            SELECT DISTINCT d.dataset_id, r.factor, r.subset
+            FROM {src} r JOIN datasets d ON d.dataset = r.dataset');
+    CALL RunMigrationStep(_src,
+        'INSERT IGNORE INTO terms (term_id, goid)
+            SELECT DISTINCT CAST(SUBSTRING(goid, 4) AS UNSIGNED), goid
+            FROM {src}');
+    CALL RunMigrationStep(_src,
+        'INSERT IGNORE INTO term_names (term_id, year, name)
+            SELECT CAST(SUBSTRING(goid, 4) AS UNSIGNED), year, MIN(term)
+            FROM {src} GROUP BY goid, year');
+    CALL RunMigrationStep(_src,
+        'INSERT IGNORE INTO runs (anno_min, anno_max, min_depth, max_depth,
+                min_var, filter_similar, filter_size, filter_depth, shuffled)
+            SELECT DISTINCT anno_min, anno_max, min_depth, max_depth, min_var,
+                filter_similar, filter_size, filter_depth, shuffled
+            FROM {src}');
+    CALL RunMigrationStep(_src,
+        'INSERT INTO results_v2 (subset_id, run_id, year, ontology, term_id,
+                pval, qval, num_annos, num_genes)
+            SELECT s.subset_id, u.run_id, r.year, r.ontology,
+                CAST(SUBSTRING(r.goid, 4) AS UNSIGNED), r.pval, r.qval,
+                r.num_annos, r.num_genes
+            FROM {src} r
+                JOIN datasets d ON d.dataset = r.dataset
+                JOIN subsets s ON s.dataset_id = d.dataset_id
+                    AND s.factor = r.factor AND s.subset = r.subset
+                JOIN runs u ON u.anno_min = r.anno_min
+                    AND u.anno_max = r.anno_max
+                    AND u.min_depth = r.min_depth
+                    AND u.max_depth = r.max_depth
+                    AND u.min_var = r.min_var
+                    AND u.filter_similar = r.filter_similar
+                    AND u.filter_size = r.filter_size
+                    AND u.filter_depth = r.filter_depth
+                    AND u.shuffled = r.shuffled
+        ON DUPLICATE KEY UPDATE pval = VALUES(pval), qval = VALUES(qval),
+            num_annos = VALUES(num_annos), num_genes = VALUES(num_genes)');
+END //
+
+DELIMITER ;
+
+CALL MigrateResultsV2('results');
+CALL MigrateResultsV2('shuffled');
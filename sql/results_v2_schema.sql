@@ -0,0 +1,82 @@
+
+-- Normalized (v2) results schema. The text and run-parameter columns that
+-- the results table repeats on every row are stored once, in dimension
+-- tables, and the fact table holds integer keys and the values.
+-- Fill it from results/shuffled with migrate_results_v2.sql.
+
+create table if not exists datasets (
+       dataset_id    smallint unsigned not null auto_increment,
+       dataset	     char(7) not null,
+       primary key (dataset_id),
+       unique key (dataset)
+);
+
+create table if not exists subsets (
+       subset_id     int unsigned not null auto_increment,
+       dataset_id    smallint unsigned not null,
+       factor	     varchar(64) not null,
+       subset	     varchar(255) not null,
+       primary key (subset_id),
+       unique key (dataset_id, factor, subset)
+);
+
+-- term_id is the integer part of the GO id (GO:0008150 -> 8150)
+create table if not exists terms (
+       term_id	     int unsigned not null,
+       goid	     char(10) not null,
+       primary key (term_id),
+       unique key (goid)
+);
+
+-- term names as they were in each year's annotations
+create table if not exists term_names (
+       term_id	     int unsigned not null,
+       year	     year(4) not null,
+       name	     varchar(1024) not null,
+       primary key (term_id, year)
+);
+
+-- the filter settings and shuffle level of a run of the analysis
+create table if not exists runs (
+       run_id	     smallint unsigned not null auto_increment,
+       anno_min	     int not null,
+       anno_max	     int not null,
+       min_depth     int not null,
+       max_depth     int not null,
+       min_var	     int not null,
+       filter_similar boolean not null,
+       filter_size    boolean not null,
+       filter_depth   boolean not null,
+       shuffled	     float not null,
+       primary key (run_id),
+       unique key (anno_min, anno_max, min_depth, max_depth, min_var,
+                   filter_similar, filter_size, filter_depth, shuffled)
+);
+
+create table if not exists results_v2 (
+       subset_id     int unsigned not null,
+       run_id	     smallint unsigned not null,
+       year	     year(4) not null,
+       ontology	     enum('MF', 'CC', 'BP') not null,
+       term_id	     int unsigned not null,
+       pval	     double not null,
+       qval	     double,
+       num_annos     int,
+       num_genes     int,
+       primary key (subset_id, run_id, year, ontology, term_id),
+       key by_pval (subset_id, run_id, year, ontology, pval),
+       key by_term (term_id, year)
+);
+
+-- the v2 tables joined back into the columns of the results table
+create or replace view results_flat as
+select r.ontology, t.goid, n.name as term, r.pval, r.qval, d.dataset,
+       s.factor, s.subset, r.year, r.num_annos, r.num_genes, u.anno_max,
+       u.anno_min, u.min_depth, u.max_depth, u.min_var, u.filter_similar,
+       u.filter_size, u.filter_depth, u.shuffled, r.run_id
+  from results_v2 r
+       join subsets s on s.subset_id = r.subset_id
+       join datasets d on d.dataset_id = s.dataset_id
+       join terms t on t.term_id = r.term_id
+       left join term_names n on n.term_id = r.term_id and n.year = r.year
+       join runs u on u.run_id = r.run_id;
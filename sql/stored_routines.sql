@@ -1,50 +1,95 @@
 DELIMITER //
 
+-- These work on the v2 schema (results_v2_schema.sql). The dataset and subset
+-- arguments may be LIKE patterns; they are matched against the small datasets
+-- and subsets tables, and everything else is joined on integer keys.
+
 DROP PROCEDURE IF EXISTS SelectTopForYear //
 CREATE PROCEDURE SelectTopForYear(IN _ds CHAR(10), IN _sub TEXT, IN _onto CHAR(2), IN _year YEAR(4), IN _max INT)
 BEGIN
-    SELECT * FROM results WHERE dataset like _ds AND subset like _sub AND ontology like _onto AND year like _year
-    ORDER BY pval limit _max;
+    SELECT r.*, d.dataset, s.subset, t.goid, n.name AS term
+        FROM datasets d
+            JOIN subsets s ON s.dataset_id = d.dataset_id
+            JOIN results_v2 r ON r.subset_id = s.subset_id
+            JOIN runs u ON u.run_id = r.run_id
+            JOIN terms t ON t.term_id = r.term_id
+            LEFT JOIN term_names n ON n.term_id = r.term_id AND n.year = r.year
+        WHERE d.dataset LIKE _ds AND s.subset LIKE _sub
+            AND r.ontology = _onto AND r.year = _year AND u.shuffled = 0
+        ORDER BY r.pval LIMIT _max;
 END//
-    
+
 
 DROP PROCEDURE IF EXISTS SelectTopShuffled //
 CREATE PROCEDURE SelectTopShuffled (IN inpct float)
 BEGIN
-    SELECT *
-        FROM shuffled WHERE pct = inpct 
-        ORDER BY dataset, subset, term, pval
+    SELECT r.*, d.dataset, s.subset, t.goid, n.name AS term
+        FROM runs u
+            JOIN results_v2 r ON r.run_id = u.run_id
+            JOIN subsets s ON s.subset_id = r.subset_id
+            JOIN datasets d ON d.dataset_id = s.dataset_id
+            JOIN terms t ON t.term_id = r.term_id
+            LEFT JOIN term_names n ON n.term_id = r.term_id AND n.year = r.year
+        WHERE u.shuffled = inpct
+        ORDER BY d.dataset, s.subset, t.goid, r.pval
         LIMIT 10;
 END //
 
+-- the 10 best terms of 2012 for each run, and their p-values in every year
 DROP PROCEDURE IF EXISTS SelectTopAcrossAll //
 CREATE PROCEDURE SelectTopAcrossAll (IN indset CHAR(10), IN insub TEXT, IN _onto CHAR(2))
 BEGIN
-    SELECT year, results.dataset, results.subset, results.term, results.pval, qval
-        FROM results, 
-            (SELECT dataset, subset, term, pval 
-                FROM results WHERE year = 2012 AND dataset like indset AND subset like insub AND ontology like _onto
-                ORDER BY pval LIMIT 10) as top
-        WHERE results.dataset like top.dataset 
-            AND results.subset like top.subset
-            AND results.term like top.term
-        ORDER BY results.dataset, results.subset, results.term, year;
+    SELECT r.year, d.dataset, s.subset, n.name AS term, t.goid, r.pval, r.qval
+        FROM (SELECT r.subset_id, r.run_id, r.ontology, r.term_id
+                FROM datasets d
+                    JOIN subsets s ON s.dataset_id = d.dataset_id
+                    JOIN results_v2 r ON r.subset_id = s.subset_id
+                    JOIN runs u ON u.run_id = r.run_id
+                WHERE r.year = 2012 AND d.dataset LIKE indset
+                    AND s.subset LIKE insub AND r.ontology = _onto
+                    AND u.shuffled = 0
+                ORDER BY r.pval LIMIT 10) AS top
+            JOIN results_v2 r ON r.subset_id = top.subset_id
+                AND r.run_id = top.run_id AND r.ontology = top.ontology
+                AND r.term_id = top.term_id
+            JOIN subsets s ON s.subset_id = r.subset_id
+            JOIN datasets d ON d.dataset_id = s.dataset_id
+            JOIN terms t ON t.term_id = r.term_id
+            LEFT JOIN term_names n ON n.term_id = r.term_id AND n.year = r.year
+        ORDER BY d.dataset, s.subset, t.goid, r.year;
 END //
 
+-- the 10 best terms of 2012 in the shuffled annotations (at shuffle level
+-- inpct), and their p-values in every year of the unshuffled ones
 DROP PROCEDURE IF EXISTS SelectTopShuffledAcrossAll //
-CREATE PROCEDURE SelectTopShuffledAcrossAll (IN indset CHAR(10))
+CREATE PROCEDURE SelectTopShuffledAcrossAll (IN indset CHAR(10), IN inpct float)
 BEGIN
-    SELECT year, results.dataset, results.subset, results.term, results.pval, qval
-        FROM results, 
-            (SELECT dataset, subset, term, pval 
-                FROM shuffled WHERE year = 2012 
-		     AND dataset like indset 
-		     AND pct = inpct
-                ORDER BY pval LIMIT 10) as top
-        WHERE results.dataset like top.dataset 
-            AND results.subset like top.subset
-            AND results.term like top.term
-        ORDER BY results.dataset, results.subset, results.term, year;
+    SELECT r.year, d.dataset, s.subset, n.name AS term, t.goid, r.pval, r.qval
+        FROM (SELECT r.subset_id, r.ontology, r.term_id, u.anno_min,
+                    u.anno_max, u.min_depth, u.max_depth, u.min_var,
+                    u.filter_similar, u.filter_size, u.filter_depth
+                FROM datasets d
+                    JOIN subsets s ON s.dataset_id = d.dataset_id
+                    JOIN results_v2 r ON r.subset_id = s.subset_id
+                    JOIN runs u ON u.run_id = r.run_id
+                WHERE r.year = 2012 AND d.dataset LIKE indset
+                    AND u.shuffled = inpct
+                ORDER BY r.pval LIMIT 10) AS top
+            -- the unshuffled run with the same filter settings
+            JOIN runs u ON u.shuffled = 0 AND u.anno_min = top.anno_min
+                AND u.anno_max = top.anno_max AND u.min_depth = top.min_depth
+                AND u.max_depth = top.max_depth AND u.min_var = top.min_var
+                AND u.filter_similar = top.filter_similar
+                AND u.filter_size = top.filter_size
+                AND u.filter_depth = top.filter_depth
+            JOIN results_v2 r ON r.subset_id = top.subset_id
+                AND r.run_id = u.run_id AND r.ontology = top.ontology
+                AND r.term_id = top.term_id
+            JOIN subsets s ON s.subset_id = r.subset_id
+            JOIN datasets d ON d.dataset_id = s.dataset_id
+            JOIN terms t ON t.term_id = r.term_id
+            LEFT JOIN term_names n ON n.term_id = r.term_id AND n.year = r.year
+        ORDER BY d.dataset, s.subset, t.goid, r.year;
 END //
 
 DELIMITER ;
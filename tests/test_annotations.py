@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'anno'))
+import Annotations
+
+
+class ReplaceObsTest(unittest.TestCase):
+
+    def goa(self, order):
+        terms = {'A': set(['GO:1']), 'B': set(['GO:2']), 'D': set(['GO:4'])}
+        return OrderedDict((g, set(terms[g])) for g in order)
+
+    def test_chains_in_either_order(self):
+        obs = {'A': ['B'], 'B': ['C']}
+        for order in ('ABD', 'BAD', 'DBA'):
+            goa = Annotations.replace_obs(self.goa(order), obs)
+            self.assertEqual(dict(goa), {'C': set(['GO:1', 'GO:2']),
+                                         'D': set(['GO:4'])}, order)
+
+    def test_demerges_deletions_and_cycles(self):
+        obs = {'A': ['B', 'D'], 'B': ['A', 'E'], 'D': []}
+        for order in ('ABD', 'DBA'):
+            goa = Annotations.replace_obs(self.goa(order), obs)
+            self.assertEqual(dict(goa), {'E': set(['GO:1', 'GO:2'])}, order)
+
+    def test_parse_obs(self):
+        fd, filename = tempfile.mkstemp(suffix='.list')
+        with os.fdopen(fd, 'w') as f:
+            f.write("P00001\tMerged into P00002.\n"
+                    "P00003\tDemerged into Q12345, A0A023GPI8 and Q23456.\n"
+                    "P00004\tDeleted.\n")
+        try:
+            self.assertEqual(Annotations.parse_obs(filename), {
+                'P00001': ['P00002'],
+                'P00003': ['Q12345', 'A0A023GPI8', 'Q23456'],
+                'P00004': []})
+        finally:
+            os.remove(filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ea'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'anno'))
+import columnar
+import import_results
+
+
+def row(goid, subset, pval, qval):
+    values = dict(ontology='BP', goid=goid, term='term %s' % goid, pval=pval,
+        dataset='GDS1234', factor='disease state', subset=subset, year=2012,
+        num_annos=100, num_genes=20, anno_min=3, anno_max=500, min_depth=0,
+        max_depth=100, min_var=0, filter_similar=False, filter_size=True,
+        filter_depth=False, shuffled=0.0, qval=qval)
+    return tuple(values[c] for c in columnar.COLUMNS)
+
+
+class PartitionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # below the smallest float32 (~1.4e-45) and at its edges
+        self.rows = [row('GO:0008150', u'normal', 4.8e-76, 1.3e-74),
+                     row('GO:0009987', u'normal', 9.8e-66, 1.4e-64),
+                     row('GO:0016740', u'cancer', 1.3e-57, None),
+                     row('GO:0003674', u'cancer', 0.05, 0.2)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        filename = columnar.write_partition(os.path.join(self.dir, 'p.npz'),
+            self.rows, columnar.COLUMNS)
+        self.assertEqual(sorted(columnar.read_partition(filename)),
+                         sorted(self.rows))
+
+    def test_import_sqlite(self):
+        sink = columnar.NpzSink(self.dir, columnar.COLUMNS)
+        sink.write(self.rows)
+        sink.close()
+        dbfile = os.path.join(self.dir, 'results.db')
+        db, write = import_results.sqlite_writer(dbfile, 'results')
+        import_results.main([self.dir], db, write)
+        with sqlite3.connect(dbfile) as db:
+            got = dict((g, (p, q)) for g, p, q in db.execute(
+                'select goid, pval, qval from results'))
+        self.assertEqual(got['GO:0008150'], (4.8e-76, 1.3e-74))
+        self.assertEqual(got['GO:0016740'], (1.3e-57, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ea'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'anno'))
+from enrichment_analysis import _fexact_batch
+from Genes import GeneUniverse
+
+UNIPROT2ENTREZ = dict(('P%d' % k, str(100 + k)) for k in xrange(40))
+ANNOTATIONS = {
+    'GO:0000001': {'name': 'a', 'genes': ['P%d' % k for k in xrange(0, 12)]},
+    'GO:0000002': {'name': 'b', 'genes': ['P%d' % k for k in xrange(5, 30)]},
+    'GO:0000003': {'name': 'c', 'genes': ['P1', 'P2', 'P39']},
+}
+DIFFEXP = [str(100 + k) for k in xrange(0, 10)] + ['999']
+BACKGROUND = [str(100 + k) for k in xrange(0, 35)] + ['999', '998']
+
+
+class FexactBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = GeneUniverse().load_entrez_map(UNIPROT2ENTREZ)
+        self.annotations = dict((t, {'name': v['name'],
+            'genes': self.universe.encode(v['genes'])})
+            for t, v in ANNOTATIONS.iteritems())
+        self.expected = _fexact_batch(DIFFEXP, BACKGROUND, ANNOTATIONS,
+                                      UNIPROT2ENTREZ)
+
+    def test_interned_genes(self):
+        results = _fexact_batch(DIFFEXP, BACKGROUND, self.annotations,
+                                self.universe)
+        for term, pval in self.expected.iteritems():
+            self.assertAlmostEqual(results[term], pval, 12)
+
+    def test_encoded_by_another_universe(self):
+        # as in a pool worker: the genes were encoded by the parent, whose
+        # copy of the universe has since grown
+        parent = GeneUniverse().load_entrez_map(UNIPROT2ENTREZ)
+        diffexp = parent.encode(DIFFEXP)
+        background = parent.encode(BACKGROUND)
+        self.assertTrue(background.max() >= len(self.universe))
+        results = _fexact_batch(diffexp, background, self.annotations,
+                                self.universe)
+        for term, pval in self.expected.iteritems():
+            self.assertAlmostEqual(results[term], pval, 12)
+
+    def test_no_diffexp(self):
+        results = _fexact_batch(numpy.array([], dtype=numpy.int32),
+            self.universe.encode(BACKGROUND), self.annotations, self.universe)
+        self.assertEqual(set(results.values()), set([1.0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import os
+import sys
+import unittest
+import scipy.stats as stats
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ea'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'anno'))
+from enrichment_analysis import FisherKernel
+
+
+class FisherKernelTest(unittest.TestCase):
+
+    def test_memo_is_bounded(self):
+        kernel = FisherKernel(max_memo=10)
+        # tables of many subsets (different margins), as in a batch run
+        for de in xrange(1, 30):
+            for g_e in xrange(1, 5):
+                table = (g_e, 10, de, 500)
+                pval = kernel.pval(*table)
+                self.assertTrue(len(kernel.memo) <= 10)
+                self.assertAlmostEqual(pval, stats.fisher_exact(
+                    [table[:2], table[2:]], alternative='greater')[1], 12)
+        # the log-factorials are kept
+        self.assertTrue(len(kernel.logfact) > 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
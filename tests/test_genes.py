@@ -0,0 +1,63 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'anno'))
+import Genes
+from Genes import GeneUniverse, intern_annotations
+
+# A -> B -> C is a chain; D is demerged into C and E; F is deleted
+OBS = {'A': ['B'], 'B': ['C'], 'D': ['C', 'E'], 'F': []}
+
+
+class ObsoleteMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = GeneUniverse(['G', 'A', 'B'])
+        self.universe.load_obsolete_map(OBS)
+
+    def replace(self, genes):
+        u = self.universe
+        return u.decode(u.replace_obsolete(u.encode(genes)))
+
+    def test_replace_obsolete_follows_chains(self):
+        self.assertEqual(self.replace(['A']), ['C'])
+        self.assertEqual(self.replace(['B', 'G']), ['G', 'C'])
+        self.assertEqual(sorted(self.replace(['A', 'D', 'F'])), ['C', 'E'])
+        # genes interned after the table was compiled are left as they are
+        self.assertEqual(self.replace(['H', 'A']), ['C', 'H'])
+
+    def test_obsolete_map(self):
+        self.assertEqual(self.universe.obsolete_map(), {
+            'A': ['C'], 'B': ['C'], 'D': ['C', 'E'], 'F': []})
+
+    def test_intern_annotations(self):
+        annotations = {'meta': {}, 'anno': {
+            'GO:0000001': {'genes': ['A', 'G', 'F']}}}
+        intern_annotations(annotations, self.universe)
+        genes = annotations['anno']['GO:0000001']['genes']
+        self.assertEqual(sorted(self.universe.decode(genes)), ['C', 'G'])
+
+    def test_saved_with_universe(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            obsfile = os.path.join(dirname, 'obsolete.list')
+            open(obsfile, 'w').close()
+            filename = os.path.join(dirname, 'genes.universe.npy')
+            self.universe.save(filename)
+            loaded = GeneUniverse.load(filename)
+            self.assertTrue(numpy.array_equal(loaded.obs_ids,
+                                              self.universe.obs_ids))
+            # newer than the (empty) list, so it's used instead
+            os.utime(obsfile, (0, 0))
+            self.assertEqual(Genes.load_obsoletes(obsfile, filename),
+                             self.universe.obsolete_map())
+        finally:
+            shutil.rmtree(dirname)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'anno'))
+import Ontology
+
+# as in data/go-2009.flat, with relation names listed as terms
+FLAT = ("GO:0008150\t\n"
+        "GO:0009987\tGO:0008150\t\n"
+        "negatively:regulates\t\n"
+        "GO:0003674\t\n"
+        "part:of\t\n"
+        "GO:0016740\tGO:0003674\tregulates\t\n")
+
+
+class CompileIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.flatfile = os.path.join(self.dir, 'go-2009.flat')
+        with open(self.flatfile, 'w') as f:
+            f.write(FLAT)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_skips_relation_names(self):
+        index = Ontology.load_index(self.flatfile)
+        self.assertEqual(index.terms.tolist(), [3674, 8150, 9987, 16740])
+        self.assertEqual(index.ancestors_of('GO:0016740'), ['GO:0003674'])
+        self.assertEqual(
+            index.in_subontology(['GO:0009987', 'GO:0016740'], 'BP').tolist(),
+            [True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ea'))
+from prefetch import Prefetcher
+
+
+class Loads(object):
+    """Counts the items loaded and not yet done with."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.held = 0
+        self.most = 0
+
+    def load(self, item):
+        if item == 'bad':
+            raise ValueError(item)
+        with self.lock:
+            self.held += 1
+            self.most = max(self.most, self.held)
+        return item
+
+    def done(self):
+        with self.lock:
+            self.held -= 1
+
+
+class PrefetcherTest(unittest.TestCase):
+
+    def run_items(self, items, **kwargs):
+        loads = Loads()
+        seen = []
+        for item, value, error in Prefetcher(items, loads.load, **kwargs):
+            seen.append((item, value, type(error).__name__ if error else None))
+            # let the loader run ahead as far as it's allowed
+            time.sleep(0.02)
+            if error is None:
+                loads.done()
+        return seen, loads.most
+
+    def test_order_and_errors(self):
+        seen, most = self.run_items(['a', 'bad', 'c'], depth=1)
+        self.assertEqual(seen, [('a', 'a', None), ('bad', None, 'ValueError'),
+                                ('c', 'c', None)])
+
+    def test_held_items_are_bounded(self):
+        for depth in (0, 1, 3):
+            seen, most = self.run_items(range(8), depth=depth)
+            self.assertEqual([x[0] for x in seen], range(8))
+            self.assertTrue(most <= depth + 1, (depth, most))
+
+    def test_byte_cap(self):
+        seen, most = self.run_items(range(8), depth=3, max_bytes=1,
+                                    size=lambda value: 1)
+        # one waiting item reaches the cap
+        self.assertTrue(most <= 2, most)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ea'))
+from sink import ResultWriter, WriterError
+
+
+class FailingSink(object):
+    """A sink that can't store anything, e.g. an unreachable database."""
+
+    def open(self):
+        pass
+
+    def write(self, rows):
+        raise IOError("database went away")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ResultWriterTest(unittest.TestCase):
+
+    def test_check_raises_on_failed_write(self):
+        writer = ResultWriter(FailingSink(), flush_secs=0.1)
+        try:
+            writer.check()
+            writer.put([('BP', 'GO:0008150', 1e-5)])
+            writer.flush()
+            deadline = time.time() + 10
+            with self.assertRaises(WriterError):
+                while time.time() < deadline:
+                    writer.check()
+                    time.sleep(0.05)
+            # still running: check() saw the failure, not a stopped process
+            self.assertTrue(writer.process.is_alive())
+        finally:
+            self.assertRaises(WriterError, writer.close)
+
+
+if __name__ == '__main__':
+    unittest.main()
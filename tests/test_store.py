@@ -0,0 +1,80 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'anno'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ea'))
+from Genes import GeneUniverse
+from Store import AnnotationStore, gather, goid2int, write_store
+import schedule
+
+ANNOTATIONS = {'meta': {'year': 2004}, 'anno': {
+    'GO:0008150': {'name': 'biological_process', 'genes': ['A', 'B', 'C'],
+                   'parents': []},
+    'GO:0000003': {'name': 'reproduction', 'genes': ['B', 'C'],
+                   'parents': ['GO:0008150']},
+    'GO:0000001': {'name': u'mitochondrion inheritance', 'genes': [],
+                   'parents': ['GO:0000003', 'GO:0008150']},
+}}
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = GeneUniverse(['A', 'B', 'C'])
+        self.store = AnnotationStore.from_annotations(ANNOTATIONS,
+                                                      self.universe)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_in_memory_store_matches_written_one(self):
+        dirname = write_store(ANNOTATIONS, os.path.join(self.tmpdir, 's'),
+                              self.universe)
+        written = AnnotationStore(dirname)
+        for name in ('terms', 'gene_offsets', 'genes', 'parent_offsets',
+                     'parents', 'names'):
+            self.assertTrue(numpy.array_equal(getattr(written, name),
+                                              getattr(self.store, name)))
+        self.assertEqual(written.meta, self.store.meta)
+        self.assertEqual(written.name(0), self.store.name(0))
+
+    def test_gather(self):
+        s = self.store
+        which, genes = gather(s.gene_offsets, s.genes, [2, 0, 1])
+        self.assertEqual(which.tolist(), [0, 0, 0, 2, 2])
+        self.assertEqual(self.universe.decode(genes), ['A', 'B', 'C', 'B', 'C'])
+        which, genes = gather(s.gene_offsets, s.genes, [])
+        self.assertEqual(len(which), 0)
+        self.assertEqual(len(genes), 0)
+
+    def test_lookup_and_entries(self):
+        s = self.store
+        ids = [goid2int(t) for t in ('GO:0000003', 'GO:0000002',
+                                     'GO:0008150')]
+        self.assertEqual(s.lookup(ids).tolist(), [1, -1, 2])
+        entries = s.entries([0, 1])
+        self.assertEqual(sorted(entries), ['GO:0000001', 'GO:0000003'])
+        self.assertEqual(entries['GO:0000003']['name'], 'reproduction')
+        self.assertEqual(
+            self.universe.decode(entries['GO:0000003']['genes']), ['B', 'C'])
+
+    def test_term_costs(self):
+        self.universe.to_entrez = numpy.array([10, 11, -1])
+        costs = schedule.term_costs(self.store, numpy.array([1, 2]),
+                                    self.universe, numpy.array([11]))
+        self.assertEqual(costs.tolist(), [schedule.TERM_COST + 2 + 1,
+                                          schedule.TERM_COST + 3 + 1])
+
+    def test_universe_check(self):
+        self.store.check_universe(GeneUniverse(['A', 'B', 'C', 'D']))
+        self.assertRaises(ValueError, self.store.check_universe,
+                          GeneUniverse(['A']))
+
+
+if __name__ == '__main__':
+    unittest.main()